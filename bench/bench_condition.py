@@ -0,0 +1,101 @@
+"""`usr.threading.Condition` with pooled `Waiter`s: wakeup latency, allocations and timers per wait.
+
+    python3 bench/bench_condition.py
+
+ping-pong: two threads hand a token back and forth through one condition, the latency is notify -> woken thread
+running. timed: the same with `wait(timeout)` so every wait arms the waiter's timer. stress: `threads` waiters
+notified one at a time and all at once, every wait must come back exactly once. stale: an expired timer callback of a
+previous wait fired into the next wait must not end it early.
+
+allocations are traced with `tracemalloc` over the steady state (the pool is warm), timers are counted by the
+`osTimer` stand-in.
+"""
+import stubs  # noqa: F401, registers the QuecPython stand-ins
+import time
+import tracemalloc
+from usr.threading import Condition, Thread
+
+
+def ping_pong(rounds, timeout=None):
+    cond = Condition()
+    state = {'turn': 0, 'sent': 0.0, 'latency': 0.0}
+
+    def player(me):
+        for _ in range(rounds):
+            with cond:
+                while state['turn'] != me:
+                    cond.wait(timeout)
+                state['latency'] += time.perf_counter() - state['sent']
+                state['turn'] = 1 - me
+                state['sent'] = time.perf_counter()
+                cond.notify()
+
+    other = Thread(target=player, args=(1,))
+    other.start()
+    started = stubs.osTimer.started
+    state['sent'] = time.perf_counter()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    player(0)
+    while state['turn'] != 0 or other.is_running():
+        time.sleep(0.001)
+    grown = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    waits = rounds * 2
+    return state['latency'] / waits * 1e6, grown / waits, (stubs.osTimer.started - started) / waits
+
+
+def stress(threads, rounds):
+    cond = Condition()
+    woken = [0]
+
+    def waiter():
+        for _ in range(rounds):
+            with cond:
+                cond.wait()
+                woken[0] += 1
+
+    workers = [Thread(target=waiter) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    start = time.perf_counter()
+    while any(worker.is_running() for worker in workers):
+        with cond:
+            cond.notify_all() if woken[0] % 2 else cond.notify()
+        time.sleep(0.0005)
+    elapsed = time.perf_counter() - start
+    assert woken[0] == threads * rounds, woken[0]
+    return elapsed
+
+
+def stale():
+    cond = Condition()
+    with cond:
+        cond.wait(0.01)  # times out, the waiter goes back to the pool
+    waiter = cond._Condition__pool[-1]
+
+    def late_callback():
+        time.sleep(0.05)
+        waiter._Waiter__on_timeout(None)  # the first wait's timer callback arriving late
+
+    Thread(target=late_callback).start()
+    start = time.perf_counter()
+    with cond:
+        cond.wait(0.3)  # reuses the pooled waiter
+    elapsed = time.perf_counter() - start
+    assert elapsed >= 0.29, 'stale timer callback ended the wait after {:.3f}s'.format(elapsed)
+    return elapsed
+
+
+def main():
+    rounds = 5000
+    print('{:<24}{:>14}{:>16}{:>16}'.format('', 'wakeup us', 'bytes per wait', 'timers per wait'))
+    for name, timeout in (('ping-pong', None), ('ping-pong timed', 5)):
+        print('{:<24}{:>14.1f}{:>16.2f}{:>16.2f}'.format(name, *ping_pong(rounds, timeout)))
+    for threads in (4, 16):
+        print('stress {} waiters x 200: {:.2f}s, every wait woken once'.format(threads, stress(threads, 200)))
+    print('stale timer callback: next wait lasted {:.3f}s of 0.3s'.format(stale()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""`usr.threading.Queue` (ring buffer) against the previous list + `pop(0)` queue.
+
+    python3 bench/bench_queue.py
+
+single thread: the queue is kept at a steady depth and every put is followed by a get, the cost of `pop(0)` grows
+with the depth. threads: one producer and one consumer thread, batch: `put_many`/`get_many` of 16 items.
+
+on CPython `list.pop(0)` is a memmove, so a single put/get costs about the same at the default depth of 100 and the
+ring only pulls ahead for deep queues. the batch operations, one lock round trip per batch, are the larger win.
+"""
+import stubs  # noqa: F401, registers the QuecPython stand-ins
+import time
+from usr.threading import Lock, Condition, Thread, Queue
+
+
+class ListQueue(object):
+    """the list backed queue replaced by the ring buffer, kept here as the baseline."""
+
+    def __init__(self, max_size=100):
+        self.__deque = []
+        self.__max_size = max_size
+        self.__lock = Lock()
+        self.__not_empty = Condition(self.__lock)
+        self.__not_full = Condition(self.__lock)
+
+    def put(self, item):
+        with self.__not_full:
+            self.__not_full.wait_for(lambda: len(self.__deque) < self.__max_size)
+            self.__deque.append(item)
+            self.__not_empty.notify()
+
+    def get(self):
+        with self.__not_empty:
+            self.__not_empty.wait_for(lambda: len(self.__deque) != 0)
+            item = self.__deque.pop(0)
+            self.__not_full.notify()
+            return item
+
+
+def steady(queue, depth, rounds):
+    for i in range(depth):
+        queue.put(i)
+    start = time.perf_counter()
+    for i in range(rounds):
+        queue.put(i)
+        queue.get()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def threaded(queue, rounds):
+    def producer():
+        for i in range(rounds):
+            queue.put(i)
+
+    start = time.perf_counter()
+    Thread(target=producer).start()
+    for _ in range(rounds):
+        queue.get()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def batched(queue, rounds, batch=16):
+    items = list(range(batch))
+    start = time.perf_counter()
+    for _ in range(rounds // batch):
+        queue.put_many(items)
+        queue.get_many(batch)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def main():
+    rounds = 20000
+    print('{:<28}{:>12}{:>12}'.format('us per put+get', 'list', 'ring'))
+    for depth, max_size in ((10, 100), (99, 100), (999, 1000), (9999, 10000)):
+        print('{:<28}{:>12.2f}{:>12.2f}'.format(
+            'steady depth {}'.format(depth),
+            steady(ListQueue(max_size), depth, rounds),
+            steady(Queue(max_size), depth, rounds),
+        ))
+    print('{:<28}{:>12.2f}{:>12.2f}'.format(
+        'producer/consumer threads', threaded(ListQueue(100), rounds), threaded(Queue(100), rounds)
+    ))
+    print('{:<28}{:>12}{:>12.2f}'.format('put_many/get_many x16', '-', batched(Queue(100), rounds)))
+
+
+if __name__ == '__main__':
+    main()
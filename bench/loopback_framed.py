@@ -0,0 +1,124 @@
+"""`usr.socketIot.FramedLink` against a second link as a local stand-in server, over an in-memory wire.
+
+    python3 bench/loopback_framed.py
+
+the wire hands the bytes of each direction to the peer's decoder in random chunk sizes, so frames arrive split and
+several to a chunk. checks, each asserting its result:
+
+    delivery: thousands of DATA frames of random sizes both ways, in order and once, acknowledged by cumulative ACKs
+        (a small max_payload makes the decoder ring wrap around all the time).
+    ack timeout: ACKs are lost, `tick` resends the unacknowledged frames after `ack_timeout` (go-back-N), the server
+        drops the duplicates and the window empties once ACKs get through again.
+    heartbeat: an idle link keeps itself alive with PING/PONG, a silent one is reported dead by `tick` after three
+        heartbeats.
+"""
+import stubs  # noqa: F401, registers the QuecPython stand-ins
+import time
+import random
+from usr.socketIot import FramedLink
+from usr.metrics import Metrics
+
+
+class Wire(object):
+    """one direction of the connection, `pump` delivers what was written to the peer link in random chunks."""
+
+    def __init__(self, rnd):
+        self.rnd = rnd
+        self.buf = bytearray()
+        self.lost = False  # drop everything written while set
+        self.peer = None
+
+    def write(self, frame):
+        if not self.lost:
+            self.buf.extend(frame)
+        return True
+
+    def pump(self):
+        received = []
+        while self.buf:
+            view = self.peer.decoder.write_view()
+            n = min(len(view), len(self.buf), self.rnd.randint(1, 64))
+            view[:n] = self.buf[:n]
+            del self.buf[:n]
+            self.peer.decoder.commit(n)
+            received.extend(self.peer.receive())
+        return received
+
+
+def connect(name, rnd, **kwargs):
+    """(client, server, client -> server wire, server -> client wire)"""
+    up, down = Wire(rnd), Wire(rnd)
+    client = FramedLink(up.write, name='{}.client'.format(name), **kwargs)
+    server = FramedLink(down.write, name='{}.server'.format(name), **kwargs)
+    up.peer, down.peer = server, client
+    return client, server, up, down
+
+
+def delivery(rnd, count=5000):
+    client, server, up, down = connect('loop.delivery', rnd, window=4, ack_timeout=5, heartbeat=0, max_payload=96)
+    sent_up, sent_down, got_up, got_down = [], [], [], []
+    unacked = 0
+    for i in range(count):
+        for link, sent in ((client, sent_up), (server, sent_down)):
+            payload = bytes(rnd.randrange(256) for _ in range(rnd.randint(0, 96)))
+            assert link.send(payload)
+            sent.append(payload)
+        unacked += 1
+        # let a few frames pile up (up to the window), one cumulative ACK covers them.
+        if unacked == 4 or rnd.random() < 0.3 or i == count - 1:
+            unacked = 0
+            while up.buf or down.buf:
+                got_up.extend(up.pump())
+                got_down.extend(down.pump())
+    assert got_up == sent_up and got_down == sent_down
+    return count
+
+
+def ack_timeout(rnd):
+    client, server, up, down = connect('loop.ack', rnd, window=4, ack_timeout=0.2, heartbeat=0, max_payload=64)
+    down.lost = True  # the server's ACKs never arrive
+    for i in range(3):
+        assert client.send(b'msg%d' % i)
+    received = up.pump()
+    time.sleep(0.25)
+    client.tick()  # ack timeout, all three frames go again
+    received += up.pump()
+    assert received == [b'msg0', b'msg1', b'msg2'], received  # duplicates dropped by the server
+    retransmits = Metrics().counter('loop.ack.client.retransmits').value
+    assert retransmits == 3, retransmits
+    down.lost = False
+    client.tick()
+    time.sleep(0.25)
+    client.tick()  # resend once more, now the cumulative ACK gets back
+    up.pump()
+    down.pump()
+    assert Metrics().gauge('loop.ack.client.unacked').value == 0
+    return retransmits
+
+
+def heartbeat(rnd):
+    client, server, up, down = connect('loop.heartbeat', rnd, heartbeat=0.1, max_payload=64)
+    for _ in range(6):  # 0.6 s idle, kept alive by PING/PONG
+        time.sleep(0.05)
+        assert client.tick()
+        up.pump()
+        down.pump()
+    up.lost = down.lost = True  # peer gone
+    start = time.time()
+    while client.tick():
+        time.sleep(0.02)
+        assert time.time() - start < 1, 'silent link not detected'
+    return time.time() - start
+
+
+def main():
+    rnd = random.Random(7)
+    print('delivery: {} frames each way in order, once'.format(delivery(rnd)))
+    print('ack timeout: {} frames resent, duplicates dropped, window drained'.format(ack_timeout(rnd)))
+    print('heartbeat: idle link kept alive, silent link dead after {:.2f}s (3 x 0.1s heartbeat)'.format(
+        heartbeat(rnd)
+    ))
+
+
+if __name__ == '__main__':
+    main()
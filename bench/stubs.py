@@ -0,0 +1,132 @@
+"""CPython stand-ins for the QuecPython modules used by `code/`, so the benchmarks run on a PC.
+
+import this module first, it registers the stand-ins in `sys.modules` and maps the `usr` package onto `code/`.
+only the behaviour the benchmarked modules rely on is modelled, timings are for comparing implementations against
+each other, not absolute numbers for the module.
+"""
+import io
+import os
+import sys
+import json
+import random
+import socket
+import zlib
+import time
+import types
+import array
+import struct
+import binascii
+import _thread
+import threading
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code')
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+usr = _module('usr')
+usr.__path__ = [CODE_DIR]
+
+for alias, module in (('uos', os), ('ujson', json), ('uarray', array), ('ustruct', struct), ('ubinascii', binascii),
+                      ('usys', sys), ('uio', io), ('urandom', random), ('usocket', socket)):
+    sys.modules[alias] = module
+sys.print_exception = lambda e: print(repr(e))
+
+_TICKS_MAX = 0x3FFFFFFF
+_module(
+    'utime',
+    time=time.time,
+    sleep=time.sleep,
+    sleep_ms=lambda ms: time.sleep(ms / 1000),
+    localtime=time.localtime,
+    ticks_ms=lambda: int(time.monotonic() * 1000) & _TICKS_MAX,
+    ticks_add=lambda ticks, delta: (ticks + delta) & _TICKS_MAX,
+    ticks_diff=lambda a, b: ((a - b + (_TICKS_MAX + 1) // 2) & _TICKS_MAX) - (_TICKS_MAX + 1) // 2,
+)
+
+
+def _start_new_thread(target, args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread.ident
+
+
+_module(
+    '_thread',
+    allocate_lock=_thread.allocate_lock,
+    get_ident=_thread.get_ident,
+    start_new_thread=_start_new_thread,
+    threadIsRunning=lambda ident: any(t.ident == ident and t.is_alive() for t in threading.enumerate()),
+    stop_thread=lambda ident: None,
+    stack_size=lambda *args: 0,
+)
+
+
+class osTimer(object):
+    """one-shot `osTimer` on top of `threading.Timer`, `periodic` is not supported."""
+    started = 0  # timers armed, the benchmarks report it per wait
+
+    def __init__(self):
+        self.__timer = None
+
+    def start(self, period_ms, periodic, callback):
+        osTimer.started += 1
+        self.__timer = threading.Timer(period_ms / 1000, callback, args=(None,))
+        self.__timer.daemon = True
+        self.__timer.start()
+
+    def stop(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+
+
+sys.modules['osTimer'] = osTimer
+
+
+def _touch(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+_module(
+    'ql_fs',
+    path_exists=os.path.exists,
+    mkdirs=lambda path: os.makedirs(path, exist_ok=True),
+    read_json=lambda path: json.load(open(path)),
+    touch=_touch,
+)
+_module('sys_bus', subscribe=lambda topic, callback: None, publish=lambda topic, msg: None)
+
+
+class _DeflateIO(object):
+    """`deflate.DeflateIO` in ZLIB format on top of `zlib`, compressed on close."""
+
+    def __init__(self, stream, fmt):
+        self.__stream = stream
+        self.__buf = bytearray()
+
+    def write(self, data):
+        self.__buf.extend(data)
+
+    def read(self):
+        return zlib.decompress(self.__stream.read())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.__stream.write(zlib.compress(bytes(self.__buf)))
+
+
+_module('deflate', ZLIB=1, DeflateIO=_DeflateIO)
+
+# cellular modules `usr.network` imports, their functions are not modelled.
+for name in ('sim', 'net', 'checkNet', 'dataCall'):
+    _module(name, setSimDet=lambda *args: 0, setCallback=lambda callback: 0)
+_module('misc', Power=None)
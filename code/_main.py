@@ -3,6 +3,7 @@ import osTimer
 from machine import Pin
 from usr import network
 from usr.dtu import DTU
+from usr.logging import BasicConfig, StreamHandler, RotatingFileHandler, MemoryRingHandler
 import dataCall
 from misc import Power
 
@@ -14,6 +15,8 @@ class Manager(object):
 
         self.dtu = DTU('Quectel')
         self.dtu.config.read_from_json('/usr/dtu_config.json')
+        self.log_ring = None
+        self.__config_log()
 
     def start(self):
         self.dog_feed_timer.start(3000, 1, self.__feed)
@@ -27,6 +30,27 @@ class Manager(object):
         # dtu应用启动
         self.dtu.run()
 
+    def __config_log(self):
+        log_config = self.dtu.config.get('log_config', {})
+        if 'level' in log_config:
+            BasicConfig.set('level', log_config['level'])
+        if 'debug' in log_config:
+            BasicConfig.set('debug', log_config['debug'])
+        if not log_config.get('async', False):
+            return
+        # 日志经后台线程批量输出，数据收发线程不再等待串口/flash 输出
+        capacity = log_config.get('queue_size', 64)
+        BasicConfig.add_handler(StreamHandler(), capacity=capacity)
+        if log_config.get('memory_records', 0) > 0:
+            self.log_ring = BasicConfig.add_handler(MemoryRingHandler(log_config['memory_records']))
+        file_config = log_config.get('file', {})
+        if file_config.get('enable', False):
+            BasicConfig.add_handler(RotatingFileHandler(
+                file_config.get('path', '/usr/dtu.log'),
+                max_bytes=file_config.get('max_bytes', 16384),
+                backup_count=file_config.get('backup_count', 2)
+            ))
+
     def __feed(self, args):
         if self.dog_pin.read():
             self.dog_pin.write(0)
@@ -59,6 +83,7 @@ class Manager(object):
                     if ret == 0:
                         print("APN配置成功，模组即将重启...")
                         self.dog_feed_timer.stop()
+                        self.dtu.config.flush()
                         Power.powerRestart()
                     else:
                         print("APN配置失败，将使用默认APN尝试拨号")
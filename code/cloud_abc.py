@@ -19,6 +19,11 @@ class CloudABC(object):
         """
         raise NotImplementedError("customer should implement this method to listen cloud message")
     
+    @property
+    def threads(self):
+        """number of threads this object runs itself (listener, reconnect, ...), counted against `max_threads`."""
+        return 0
+
     def recv(self):
         """receive a message"""
         raise NotImplementedError("customer should implement this method to recv a message")
@@ -0,0 +1,243 @@
+import uio
+import uarray
+import ustruct
+from usr.metrics import Metrics
+try:
+    import deflate  # MicroPython >= 1.21, compression and decompression
+except ImportError:
+    deflate = None
+try:
+    import uzlib  # older firmwares, decompression only
+except ImportError:
+    uzlib = None
+
+
+class Codec(object):
+    """payload codec, `ID` is the header byte that tells the receiver how to decode."""
+    ID = None
+    NAME = None
+
+    def encode(self, data):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+
+class RawCodec(Codec):
+    ID = 0x00
+    NAME = 'raw'
+
+    def encode(self, data):
+        return data
+
+    def decode(self, data):
+        return data
+
+
+class ZlibCodec(Codec):
+    ID = 0x01
+    NAME = 'zlib'
+
+    def encode(self, data):
+        if deflate is None:
+            raise ValueError('zlib encoding needs the `deflate` module, not available on this firmware.')
+        stream = uio.BytesIO()
+        with deflate.DeflateIO(stream, deflate.ZLIB) as f:
+            f.write(data)
+        return stream.getvalue()
+
+    def decode(self, data):
+        if deflate is not None:
+            return deflate.DeflateIO(uio.BytesIO(bytes(data)), deflate.ZLIB).read()
+        return uzlib.decompress(bytes(data))
+
+
+class LzfCodec(Codec):
+    """pure-Python LZF (LZ77 with a 3 byte hash and 8 KB window).
+
+    an optional preset `dictionary` (e.g. a typical frame) primes the window, so even a single short frame finds
+    matches. both ends must use the same dictionary.
+
+    the hash table is preallocated: `__preset` holds the dictionary positions and is built once, `__table` the
+    positions of the current frame stored as `epoch + i`. every `encode` starts a new epoch, older entries fall back
+    to the preset slot, so nothing is copied or cleared per frame. candidates are verified against the data, a slot
+    overwritten by a colliding hash (or a concurrent `encode`) only costs a match.
+    """
+    ID = 0x02
+    NAME = 'lzf'
+    MAX_OFFSET = 8192
+    MAX_LENGTH = 264
+    HLOG = 11
+    HSIZE = 1 << HLOG
+    MAX_EPOCH = 0x3FFFFFFF
+
+    def __init__(self, dictionary=b''):
+        if isinstance(dictionary, str):
+            dictionary = dictionary.encode()
+        self.__dictionary = bytes(dictionary[-self.MAX_OFFSET:])
+        self.__preset = uarray.array('i', [-1] * self.HSIZE)
+        for i in range(len(self.__dictionary) - 2):
+            self.__preset[self.__slot(self.__dictionary, i)] = i
+        self.__table = uarray.array('i', [-1] * self.HSIZE)
+        self.__epoch = 0
+
+    @classmethod
+    def __slot(cls, data, i):
+        key = (data[i] << 16) | (data[i + 1] << 8) | data[i + 2]
+        return ((key >> (24 - cls.HLOG)) - key * 5) & (cls.HSIZE - 1)
+
+    @staticmethod
+    def __literals(out, data, start, end):
+        while start < end:
+            count = min(32, end - start)
+            out.append(count - 1)
+            out.extend(data[start:start + count])
+            start += count
+
+    def encode(self, data):
+        base = len(self.__dictionary)
+        data = self.__dictionary + bytes(data) if base else data
+        size = len(data)
+        table = self.__table
+        preset = self.__preset
+        epoch = self.__epoch
+        if epoch + size > self.MAX_EPOCH:
+            for h in range(self.HSIZE):
+                table[h] = -1
+            epoch = 0
+        self.__epoch = epoch + size
+        shift = 24 - self.HLOG
+        mask = self.HSIZE - 1
+        max_offset = self.MAX_OFFSET
+        out = bytearray()
+        literal = i = base
+        while i + 2 < size:
+            key = (data[i] << 16) | (data[i + 1] << 8) | data[i + 2]
+            h = ((key >> shift) - key * 5) & mask  # same as `__slot`, inlined on the hot path
+            ref = table[h]
+            ref = ref - epoch if ref >= epoch else preset[h]
+            table[h] = epoch + i
+            if 0 <= ref < i and i - ref <= max_offset and data[ref] == data[i] \
+                    and data[ref + 1] == data[i + 1] and data[ref + 2] == data[i + 2]:
+                limit = min(size - i, self.MAX_LENGTH)
+                length = 3
+                while length < limit and data[ref + length] == data[i + length]:
+                    length += 1
+                self.__literals(out, data, literal, i)
+                offset = i - ref - 1
+                if length - 2 < 7:
+                    out.append(((length - 2) << 5) | (offset >> 8))
+                else:
+                    out.append((7 << 5) | (offset >> 8))
+                    out.append(length - 2 - 7)
+                out.append(offset & 0xFF)
+                i += length
+                literal = i
+            else:
+                i += 1
+        self.__literals(out, data, literal, size)
+        return out
+
+    def decode(self, data):
+        base = len(self.__dictionary)
+        out = bytearray(self.__dictionary)
+        i = 0
+        size = len(data)
+        while i < size:
+            ctrl = data[i]
+            i += 1
+            if ctrl < 32:
+                out.extend(data[i:i + ctrl + 1])
+                i += ctrl + 1
+                continue
+            length = ctrl >> 5
+            if length == 7:
+                length += data[i]
+                i += 1
+            ref = len(out) - ((ctrl & 0x1F) << 8) - data[i] - 1
+            i += 1
+            for _ in range(length + 2):
+                out.append(out[ref])
+                ref += 1
+        return out[base:] if base else out
+
+
+CODECS = {codec.NAME: codec for codec in (RawCodec, ZlibCodec, LzfCodec)}
+
+
+class Envelope(object):
+    """`<codec id:1><payload>` messages. `encode` falls back to raw when the codec does not make the payload
+    smaller, `decode` accepts any known codec id. with `stream` (tcp) every envelope is also prefixed with its
+    length as `<length:2>` so the receiver can split the byte stream again, see `StreamDecoder`.
+    """
+
+    def __init__(self, codec='raw', stream=False, name='codec'):
+        """codec - codec name or {"name": ..., other codec arguments}. name - prefix of the metric names."""
+        options = dict(codec) if isinstance(codec, dict) else {'name': codec}
+        codec_name = options.pop('name', 'raw')
+        if codec_name not in CODECS:
+            raise ValueError('codec \"{}\" not supported, choose from {}.'.format(codec_name, tuple(CODECS.keys())))
+        if codec_name == ZlibCodec.NAME and deflate is None:
+            raise ValueError('zlib codec needs the `deflate` module, not available on this firmware.')
+        self.__codec = CODECS[codec_name](**options)
+        # decoders for every codec id, the configured one carries its options (e.g. the lzf dictionary).
+        self.__codecs = {codec.ID: codec() for codec in CODECS.values()}
+        self.__codecs[self.__codec.ID] = self.__codec
+        self.__stream = stream
+        metrics = Metrics()
+        # raw_bytes / encoded_bytes is the achieved compression ratio.
+        self.__raw_bytes = metrics.counter('{}.raw_bytes'.format(name))
+        self.__encoded_bytes = metrics.counter('{}.encoded_bytes'.format(name))
+
+    def __repr__(self):
+        return '<Envelope {}>'.format(self.__codec.NAME)
+
+    def encode(self, data):
+        codec = self.__codec
+        payload = codec.encode(data)
+        if len(payload) >= len(data):
+            codec = self.__codecs[RawCodec.ID]
+            payload = data
+        header = 3 if self.__stream else 1
+        if len(payload) + 1 > 0xFFFF:
+            raise ValueError('envelope of {} bytes too large.'.format(len(payload)))
+        out = bytearray(header + len(payload))
+        if self.__stream:
+            ustruct.pack_into('!H', out, 0, len(payload) + 1)
+        out[header - 1] = codec.ID
+        out[header:] = payload
+        self.__raw_bytes.inc(len(data))
+        self.__encoded_bytes.inc(len(out))
+        return out
+
+    def decode(self, data):
+        codec = self.__codecs.get(data[0])
+        if codec is None:
+            raise ValueError('unknown codec id 0x{:02x}.'.format(data[0]))
+        return codec.decode(memoryview(data)[1:])
+
+
+class StreamDecoder(object):
+    """split a tcp byte stream of length-prefixed envelopes and decode them, partial envelopes are kept until the
+    rest arrives.
+    """
+
+    def __init__(self, envelope):
+        self.__envelope = envelope
+        self.__pending = bytearray()
+
+    def feed(self, data):
+        """decoded payloads of every envelope completed by `data`."""
+        self.__pending.extend(data)
+        rv = []
+        offset = 0
+        while len(self.__pending) - offset >= 2:
+            length = ustruct.unpack_from('!H', self.__pending, offset)[0]
+            if len(self.__pending) - offset - 2 < length:
+                break
+            rv.append(bytes(self.__envelope.decode(memoryview(self.__pending)[offset + 2:offset + 2 + length])))
+            offset += 2 + length
+        if offset:
+            self.__pending = self.__pending[offset:]
+        return rv
@@ -1,6 +1,16 @@
+import uos
+import utime
+import ujson
 import ql_fs
-from usr.utils import Singleton
-from usr.threading import Lock
+from usr.utils import Singleton, crc32
+from usr.logging import getLogger
+from usr.threading import Lock, Condition, Thread
+
+
+logger = getLogger(__name__)
+
+
+_MISSING = object()
 
 
 @Singleton
@@ -10,71 +20,207 @@ class Configure(object):
     DEL = 0x03
     LOCK = Lock()
     DEFAULT_CONFIG_PATH = '/usr/default_config.json'
+    SAVE_DELAY = 2  # seconds a `save` waits for further changes before writing flash
 
     def __init__(self):
         self.path = None
-        self.settings = None
+        self.__dirty = 0  # bumped by every `save`, cleared once that generation is on flash
+        self.__deadline = None
+        self.__save_cond = Condition()
+        self.__flush_lock = Lock()
+        self.__save_thread = Thread(target=self.__save_thread_worker)
+        # (settings, value cache) swapped as one reference. settings are copy-on-write, a published tree is never
+        # mutated, so `get` reads it without taking the lock.
+        self.__snapshot = (None, {})
+        self.__paths = {}  # key string -> tuple of path components
         self.reset_default()
 
     def __repr__(self):
         return 'Configure(path=\'{}\')'.format(self.path)
 
+    @property
+    def settings(self):
+        return self.__snapshot[0]
+
+    def snapshot(self):
+        """current settings tree, it will not change under the caller and must be treated as read-only."""
+        return self.__snapshot[0]
+
+    def __publish(self, settings):
+        self.__snapshot = (settings, {})
+
+    def __compile(self, key):
+        path = self.__paths.get(key)
+        if path is None:
+            path = tuple(key.split('.'))
+            self.__paths[key] = path
+        return path
+
     def reset_default(self):
         if ql_fs.path_exists(self.DEFAULT_CONFIG_PATH):
             with self.LOCK:
-                self.settings = ql_fs.read_json(self.DEFAULT_CONFIG_PATH)
+                self.__publish(ql_fs.read_json(self.DEFAULT_CONFIG_PATH))
+
+    @staticmethod
+    def __load(path):
+        # return settings in `path` if it parses and matches its checksum file (when present), else None.
+        if not ql_fs.path_exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            crc_path = path + '.crc'
+            if ql_fs.path_exists(crc_path) and ql_fs.read_json(crc_path).get('crc') != crc32(raw):
+                raise ValueError('checksum mismatch')
+            settings = ujson.loads(raw)
+            if not isinstance(settings, dict):
+                raise ValueError('not a json object')
+            return settings
+        except Exception as e:
+            logger.error('load \"{}\" failed: {}'.format(path, e))
+            return None
 
     def read_from_json(self, path):
+        """load settings, falling back to the backup of the last good save if `path` is missing or corrupt."""
         self.path = path
         with self.LOCK:
-            if not ql_fs.path_exists(path):
-                raise ValueError('\"{}\" not exists!'.format(path))
-            self.settings = ql_fs.read_json(path)
-
-    def save(self):
-        with self.LOCK:
-            ql_fs.touch(self.path, self.settings)
-
-    def get(self, key):
-        with self.LOCK:
-            return self.execute(self.settings, key.split('.'), operate=self.GET)
+            settings = self.__load(path)
+            if settings is None:
+                settings = self.__load(path + '.bak')
+                if settings is None:
+                    raise ValueError('\"{}\" not exists!'.format(path))
+                logger.warn('\"{}\" corrupt, recovered from backup.'.format(path))
+            self.__publish(settings)
+
+    def save(self, delay=None):
+        """write settings back to `path` after `delay` seconds (default `SAVE_DELAY`) without further changes.
+
+        every call restarts the window, so a burst of `set` calls costs one flash write. `delay=0` writes now.
+        """
+        delay = self.SAVE_DELAY if delay is None else delay
+        if delay <= 0:
+            with self.__save_cond:
+                self.__dirty += 1
+            return self.flush()
+        with self.__save_cond:
+            self.__dirty += 1
+            self.__deadline = utime.ticks_add(utime.ticks_ms(), int(delay * 1000))
+            self.__save_cond.notify_all()
+        if not self.__save_thread.is_running():
+            self.__save_thread.start()
+
+    def flush(self):
+        """write pending changes now: temp file + rename, keeping the previous file as `.bak`."""
+        with self.__save_cond:
+            generation = self.__dirty
+            if not generation:
+                return True
+        try:
+            if self.path is None:
+                raise ValueError('no path, settings were not read from a json file')
+            raw = ujson.dumps(self.snapshot()).encode()
+            tmp_path = self.path + '.tmp'
+            with self.__flush_lock:
+                with open(tmp_path, 'wb') as f:
+                    f.write(raw)
+                # checksum first: a crash in between leaves the main file without a checksum, not a stale one.
+                for suffix in ('.crc', ''):
+                    if ql_fs.path_exists(self.path + suffix):
+                        if ql_fs.path_exists(self.path + '.bak' + suffix):
+                            uos.remove(self.path + '.bak' + suffix)
+                        uos.rename(self.path + suffix, self.path + '.bak' + suffix)
+                uos.rename(tmp_path, self.path)
+                ql_fs.touch(self.path + '.crc', {'crc': crc32(raw)})
+        except Exception as e:
+            logger.error('save \"{}\" failed: {}'.format(self.path, e))
+            return False
+        with self.__save_cond:
+            if self.__dirty == generation:
+                self.__dirty = 0
+        return True
+
+    def __save_thread_worker(self):
+        while True:
+            with self.__save_cond:
+                self.__save_cond.wait_for(lambda: self.__dirty and self.__deadline is not None)
+                remaining = utime.ticks_diff(self.__deadline, utime.ticks_ms())
+                if remaining > 0:
+                    self.__save_cond.wait(remaining / 1000)
+                    continue
+                self.__deadline = None
+            self.flush()
+
+    def get(self, key, default=_MISSING):
+        settings, cache = self.__snapshot
+        value = cache.get(key, _MISSING)
+        if value is _MISSING:
+            try:
+                value = self.execute(settings, self.__compile(key), operate=self.GET)
+            except KeyError:
+                if default is _MISSING:
+                    raise
+                return default
+            cache[key] = value
+        return value
 
     def __getitem__(self, item):
         return self.get(item)
 
-    def set(self, key, value):
+    def __modify(self, key, value, operate):
+        path = self.__compile(key)
         with self.LOCK:
-            return self.execute(self.settings, key.split('.'), value=value, operate=self.SET)
+            settings = self.__copy_path(self.settings, path)
+            rv = self.execute(settings, path, value=value, operate=operate)
+            self.__publish(settings)
+            return rv
+
+    def set(self, key, value):
+        return self.__modify(key, value, self.SET)
 
     def __setitem__(self, key, value):
         return self.set(key, value)
 
     def delete(self, key):
-        with self.LOCK:
-            return self.execute(self.settings, key.split('.'), operate=self.DEL)
+        return self.__modify(key, None, self.DEL)
 
     def __delitem__(self, key):
         return self.delete(key)
 
+    def __copy_path(self, settings, path):
+        # shallow-copy every dict along `path`, the rest of the tree is shared with the published snapshot.
+        if settings is None:
+            return None
+        root = dict(settings)
+        node = root
+        for i in range(len(path) - 1):
+            child = node.get(path[i])
+            if not isinstance(child, dict):
+                break
+            child = dict(child)
+            node[path[i]] = child
+            node = child
+        return root
+
     def execute(self, dict_, keys, value=None, operate=None):
-        if self.settings is None:
+        if dict_ is None:
             raise ValueError('settings not loaded. pls use `Config.read_from_json` to load settings from a json file.')
 
-        key = keys.pop(0)
-
-        if len(keys) == 0:
-            if operate == self.GET:
-                return dict_[key]
-            elif operate == self.SET:
-                dict_[key] = value
-            elif operate == self.DEL:
-                del dict_[key]
-            return
-
-        if key not in dict_:
-            if operate == self.SET:
-                dict_[key] = {}  # auto create sub items recursively.
-            else:
-                return
-
-        return self.execute(dict_[key], keys, value=value, operate=operate)
+        last = len(keys) - 1
+        for i in range(last):
+            key = keys[i]
+            if key not in dict_:
+                if operate == self.SET:
+                    dict_[key] = {}  # auto create sub items.
+                elif operate == self.GET:
+                    raise KeyError(key)
+                else:
+                    return
+            dict_ = dict_[key]
+
+        key = keys[last]
+        if operate == self.GET:
+            return dict_[key]
+        elif operate == self.SET:
+            dict_[key] = value
+        elif operate == self.DEL:
+            del dict_[key]
@@ -0,0 +1,160 @@
+from usr.logging import getLogger
+from usr.threading import Queue, Thread
+from usr.metrics import Metrics
+
+
+logger = getLogger(__name__)
+
+
+class TopicTrie(object):
+    """MQTT topic filters compiled into a trie, `match` walks one node per topic level instead of testing every
+    filter. `+` matches exactly one level, `#` matches the rest of the topic including its parent level.
+    """
+
+    def __init__(self):
+        self.__root = ({}, [])  # (children by level, values of filters ending here)
+
+    def insert(self, topic_filter, value):
+        levels = topic_filter.split('/')
+        if '#' in levels[:-1]:
+            raise ValueError('\"#\" must be the last level of topic filter \"{}\".'.format(topic_filter))
+        node = self.__root
+        for level in levels:
+            child = node[0].get(level)
+            if child is None:
+                child = ({}, [])
+                node[0][level] = child
+            node = child
+        node[1].append(value)
+
+    def match(self, topic):
+        """values of every filter matching `topic`."""
+        rv = []
+        nodes = [self.__root]
+        for level in topic.split('/'):
+            matched = []
+            for children, _ in nodes:
+                child = children.get('#')
+                if child is not None:
+                    rv.extend(child[1])
+                child = children.get(level)
+                if child is not None:
+                    matched.append(child)
+                child = children.get('+')
+                if child is not None:
+                    matched.append(child)
+            nodes = matched
+            if not nodes:
+                return rv
+        for children, values in nodes:
+            rv.extend(values)
+            child = children.get('#')
+            if child is not None:
+                rv.extend(child[1])
+        return rv
+
+
+class PrefixTable(object):
+    """byte prefixes bucketed by their first byte, `match` returns the longest prefix `data` starts with."""
+
+    def __init__(self):
+        self.__buckets = {}
+
+    def insert(self, prefix, value):
+        if isinstance(prefix, str):
+            prefix = prefix.encode()
+        if not prefix:
+            raise ValueError('empty prefix.')
+        bucket = self.__buckets.setdefault(prefix[0], [])
+        bucket.append((prefix, value))
+        bucket.sort(key=lambda item: -len(item[0]))
+
+    def match(self, data):
+        """(value, prefix length) of the longest matching prefix, (None, 0) if none matches."""
+        if data:
+            for prefix, value in self.__buckets.get(data[0], ()):
+                if data.startswith(prefix):
+                    return value, len(prefix)
+        return None, 0
+
+
+class Dispatcher(object):
+    """route downlink messages to named handlers.
+
+    a route is a dict with `handler` and either an MQTT `topic` filter or a TCP `prefix` (stripped from the payload
+    before the handler sees it), the first matching route in `add_route` order wins and unmatched messages go to
+    `default`. routes with `priority` run on the control lane, everything else on the data lane, each lane has its own
+    queue and worker thread so a command is never stuck behind a backlog of bulk data.
+    handlers are called as `handler(msg, payload, route)`.
+    """
+    CONTROL = 'control'
+    DATA = 'data'
+
+    def __init__(self, default=None, control_queue=16, data_queue=64):
+        self.__handlers = {}
+        self.__topics = TopicTrie()
+        self.__prefixes = PrefixTable()
+        self.__routes = 0
+        self.__default = default
+        self.__lanes = {self.CONTROL: Queue(max_size=control_queue), self.DATA: Queue(max_size=data_queue)}
+        metrics = Metrics()
+        self.__dispatched = {lane: metrics.counter('dispatch.{}'.format(lane)) for lane in self.__lanes}
+        self.__errors = metrics.counter('dispatch.errors')
+        for lane, queue in self.__lanes.items():
+            metrics.gauge('dispatch.{}_queue'.format(lane), queue.size)
+
+    def register(self, name, handler):
+        self.__handlers[name] = handler
+
+    def add_route(self, route):
+        if route.get('handler') not in self.__handlers:
+            raise ValueError('downlink handler \"{}\" not registered.'.format(route.get('handler')))
+        entry = (self.__routes, route)
+        if 'topic' in route:
+            self.__topics.insert(route['topic'], entry)
+        elif 'prefix' in route:
+            self.__prefixes.insert(route['prefix'], entry)
+        else:
+            raise ValueError('downlink route needs a \"topic\" or \"prefix\".')
+        self.__routes += 1
+
+    def match(self, msg):
+        """(route, payload) for `msg`, the default route and the whole payload if nothing matches."""
+        data = msg['data']
+        topic = msg.get('topic')
+        if topic is not None:
+            if isinstance(topic, bytes):
+                topic = topic.decode()
+            entries = self.__topics.match(topic)
+            if entries:
+                return min(entries, key=lambda entry: entry[0])[1], data
+        else:
+            entry, length = self.__prefixes.match(data)
+            if entry is not None:
+                return entry[1], memoryview(data)[length:]
+        return self.__default, data
+
+    def dispatch(self, msg):
+        """queue `msg` on its lane, blocks while the lane is full."""
+        route, payload = self.match(msg)
+        if route is None:
+            logger.warn('no downlink route for message, dropped.')
+            return False
+        lane = self.CONTROL if route.get('priority') else self.DATA
+        self.__lanes[lane].put((msg, payload, route))
+        self.__dispatched[lane].inc()
+        return True
+
+    def start(self):
+        for lane in self.__lanes:
+            Thread(target=self.__lane_worker, args=(lane,)).start()
+
+    def __lane_worker(self, lane):
+        queue = self.__lanes[lane]
+        while True:
+            msg, payload, route = queue.get()
+            try:
+                self.__handlers[route['handler']](msg, payload, route)
+            except Exception as e:
+                self.__errors.inc()
+                logger.error('downlink handler \"{}\" error: {}'.format(route['handler'], e))
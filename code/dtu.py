@@ -1,84 +1,568 @@
+import utime
+import ujson
+import app_fota
+from misc import Power
 from usr.serial import Serial
+from usr.metrics import Metrics
+from usr.tracing import Tracer
+from usr.spool import Spool
+from usr.framing import Framer
 from usr.mqttIot import MqttIot
 from usr.socketIot import SocketIot
-from usr.logging import getLogger
+from usr.router import CloudRouter
+from usr.dispatcher import Dispatcher
+from usr.logging import getLogger, Level
 from usr.configure import Configure
-from usr.threading import Thread
+from usr.threading import Thread, Lock, ByteQueue
 
 
 logger = getLogger(__name__)
 
 
-class DTU(object):
+class Channel(object):
+    """one serial port bridged to the cloud.
 
-    def __init__(self, name):
+    `route` selects where the channel's data goes: `to` lists the cloud endpoints it is sent to (the first one is
+    the primary path, the rest get best-effort copies), with MQTT the `publish`/`subscribe` keys of the topic tables
+    (default "up"/"down"), with TCP an optional `socket` dict overriding `socket_private_cloud_config` to give the
+    channel its own connection when no `cloud_router` is configured.
+    """
+
+    def __init__(self, index, name, uart_config, route=None):
+        self.index = index
         self.name = name
-        self.config = Configure()
+        self.uart_config = dict(uart_config)
+        self.framing = self.uart_config.pop('framing', None) or {}
+        self.route = route or {}
+        self.targets = self.route.get('to')  # endpoint names, defaulted by the DTU
+        if isinstance(self.targets, str):
+            self.targets = [self.targets]
+        # byte 0 is reserved for the channel tag, so a frame at `up_view[1:]` is spooled tagged without a copy.
+        self.up_buf = bytearray(self.framing.get('max_length', 1024) + 1)
+        self.up_view = memoryview(self.up_buf)
+        self.up_buf[0] = index
 
     def __str__(self):
-        return '<DTU \"{}\">'.format(self.name)
+        return '<Channel {} \"{}\">'.format(self.index, self.name)
+
+    @property
+    def publish(self):
+        return self.route.get('publish', 'up')
+
+    @property
+    def subscribe(self):
+        return self.route.get('subscribe', 'down')
 
     @property
     def serial(self):
         __serial__ = getattr(self, '__serial__', None)
         if __serial__ is None:
-            __serial__ = Serial(**self.config.get('uart_config'))
+            __serial__ = Serial(**self.uart_config)
             __serial__.open()
             setattr(self, '__serial__', __serial__)
         return __serial__
 
-    def __create_cloud(self):
-        cloud_type = self.config.get('system_config.cloud')
+    @property
+    def framer(self):
+        __framer__ = getattr(self, '__framer__', None)
+        if __framer__ is None:
+            __framer__ = Framer(self.serial, **self.framing)
+            setattr(self, '__framer__', __framer__)
+        return __framer__
+
+
+class DTU(object):
+    MAX_SPOOL_ATTEMPTS = 3  # failed sends of a spooled record while its cloud is online before it is dropped
+    MAX_THREADS = 16  # default `system_config.max_threads`
+
+    def __init__(self, name):
+        self.name = name
+        self.config = Configure()
+        # preallocated sender buffer, byte 0 carries the channel tag when a record is spooled and the cloud gets
+        # memoryview slices of `__tx_buf[1:]`.
+        self.__tx_buf = bytearray(1025)
+        self.__tx_view = memoryview(self.__tx_buf)
+        # `spill` overflow: readers move the queue head to the spool under this lock, the sender holds it from
+        # dequeue until the record is sent or spooled, so a record in hand is never overtaken by spilled ones.
+        self.__spill_lock = Lock()
+        self.__spill_buf = None
+        metrics = Metrics()
+        self.__up_frames = metrics.counter('dtu.up.frames')
+        self.__up_bytes = metrics.counter('dtu.up.bytes')
+        self.__up_dropped = metrics.counter('dtu.up.dropped')
+        self.__up_spooled = metrics.counter('dtu.up.spooled')
+        self.__up_spilled = metrics.counter('dtu.up.spilled')
+        self.__up_send_failed = metrics.counter('dtu.up.send_failed')
+        self.__up_rejected = metrics.counter('dtu.up.rejected')
+        self.__spool_attempts = 0
+        self.__down_msgs = metrics.counter('dtu.down.msgs')
+        self.__down_bytes = metrics.counter('dtu.down.bytes')
+        self.__down_errors = metrics.counter('dtu.down.errors')
+        # bound from `tracers` by `run`, settings are not loaded yet when the DTU is constructed.
+        self.__up_tracer = None
+        self.__down_tracer = None
+
+    def __str__(self):
+        return '<DTU \"{}\">'.format(self.name)
+
+    @property
+    def channels(self):
+        """bridged serial ports, from `channels` or, for older configs, the single `uart_config`."""
+        channels = getattr(self, '__channels__', None)
+        if channels is None:
+            channels_config = self.config.get('channels', None)
+            if not channels_config:
+                channels_config = [{'name': 'uart', 'uart_config': self.config.get('uart_config')}]
+            if len(channels_config) > 0xFF:
+                raise ValueError('at most 255 channels supported.')
+            channels = []
+            for index, item in enumerate(channels_config):
+                channels.append(Channel(
+                    index, item.get('name', 'uart{}'.format(index)), item['uart_config'], route=item.get('route')
+                ))
+            size = max(len(channel.up_buf) for channel in channels)
+            if size > len(self.__tx_buf):
+                self.__tx_buf = bytearray(size)
+                self.__tx_view = memoryview(self.__tx_buf)
+            setattr(self, '__channels__', channels)
+        return channels
+
+    @property
+    def serial(self):
+        return self.channels[0].serial
+
+    @property
+    def framer(self):
+        return self.channels[0].framer
+
+    @property
+    def spool(self):
+        """store-and-forward spool for uplink data while the cloud is offline, None if disabled.
+
+        every spooled record starts with the index of the channel it came from.
+        """
+        if not hasattr(self, '__spool__'):
+            spool_config = dict(self.config.get('spool_config', {}))
+            self.__spool_batch = spool_config.pop('batch', 32)
+            if spool_config.pop('enable', False):
+                spool = Spool(**spool_config)
+                Metrics().gauge('dtu.spool.bytes', spool.size)
+                setattr(self, '__spool__', spool)
+            else:
+                setattr(self, '__spool__', None)
+        return getattr(self, '__spool__')
+
+    @property
+    def uplink_queue(self):
+        """byte-budgeted queue shared by all serial readers and drained by the one cloud sender thread."""
+        queue = getattr(self, '__uplink_queue__', None)
+        if queue is None:
+            uplink_config = self.config.get('uplink_config', {})
+            overflow = uplink_config.get('overflow', ByteQueue.BLOCK)
+            # `spill` moves the oldest frames from RAM to the spool to make room for the newest one.
+            self.__spill = overflow == 'spill'
+            queue = ByteQueue(
+                capacity=uplink_config.get('queue_bytes', 8192),
+                policy=ByteQueue.DROP_NEWEST if self.__spill else overflow
+            )
+            setattr(self, '__uplink_queue__', queue)
+            metrics = Metrics()
+            metrics.gauge('dtu.uplink_queue.bytes', queue.size)
+            metrics.gauge('dtu.uplink_queue.records', queue.count)
+            metrics.gauge('dtu.uplink_queue.high_water', lambda: queue.high_water_mark)
+            metrics.gauge('dtu.uplink_queue.dropped', lambda: queue.dropped[0])
+        return queue
+
+    def __create_cloud(self, cloud_type, overrides=None, name=None):
+        # the default endpoint keeps the plain metric names (`mqtt.*`, `tcp.*`), the others are namespaced by `name`.
+        name = None if name == self.__default_endpoint else name
         if cloud_type == "mqtt":
-            mqtt_config = self.config.get('mqtt_private_cloud_config')
-            cloud = MqttIot(**mqtt_config)
+            mqtt_config = dict(self.config.get('mqtt_private_cloud_config'))
+            mqtt_config.update(overrides or {})
+            cloud = MqttIot(name=name, **mqtt_config)
         elif cloud_type == "tcp":
-            socket_config = self.config.get('socket_private_cloud_config')
-            cloud = SocketIot(**socket_config)
+            socket_config = dict(self.config.get('socket_private_cloud_config'))
+            socket_config.update(overrides or {})
+            cloud = SocketIot(name=name, **socket_config)
         else:
             raise ValueError('\"{}\" not supported now!'.format(cloud_type))
         cloud.connect()
         cloud.listen()
         return cloud
 
+    @property
+    def router(self):
+        """cloud endpoints from `cloud_router`, or for older configs the `system_config.cloud` connection (named
+        "default") plus the dedicated sockets of channel routes.
+        """
+        router = getattr(self, '__router__', None)
+        if router is None:
+            router_config = dict(self.config.get('cloud_router', {}))
+            endpoints = router_config.pop('endpoints', None)
+            self.__default_endpoint = router_config.pop('default', 'default')
+            router = CloudRouter(**router_config)
+            if endpoints:
+                for name, item in endpoints.items():
+                    router.add(
+                        name, self.__create_cloud(item.get('cloud'), item.get('config'), name=name),
+                        backup=item.get('backup')
+                    )
+            else:
+                cloud_type = self.config.get('system_config.cloud')
+                router.add(self.__default_endpoint, self.__create_cloud(cloud_type, name=self.__default_endpoint))
+                for channel in self.channels:
+                    socket_route = channel.route.get('socket')
+                    if socket_route and cloud_type == 'tcp' and not channel.targets:
+                        channel.targets = ['socket.{}'.format(channel.name)]
+                        target = channel.targets[0]
+                        router.add(target, self.__create_cloud(cloud_type, socket_route, name=target))
+            for channel in self.channels:
+                channel.targets = channel.targets or [self.__default_endpoint]
+            router.start()
+            setattr(self, '__router__', router)
+        return router
+
     @property
     def cloud(self):
-        cloud = getattr(self, '__cloud__', None)
-        if cloud is None:
-            cloud = self.__create_cloud()
-            setattr(self, '__cloud__', cloud)
-        return cloud
+        """the connection of the default endpoint (or its backup after a failover)."""
+        return self.router.get(self.router.active(self.__default_endpoint))
+
+    def __downlinks(self):
+        # one downlink per endpoint: [(cloud, default channel, {topic: channel})]. tcp data goes to the first channel
+        # sending there (through the endpoint itself or as its backup), mqtt messages are dispatched by topic.
+        downlinks = []
+        for endpoint in self.router.endpoints:
+            default = self.channels[0]
+            for channel in self.channels:
+                if endpoint.name in channel.targets or endpoint.name == self.router.backup(channel.targets[0]):
+                    default = channel
+                    break
+            topics = {}
+            if isinstance(endpoint.cloud, MqttIot):
+                for channel in self.channels:
+                    topic = endpoint.cloud.subscribe_topic.get(channel.subscribe)
+                    if topic is not None:
+                        topics.setdefault(topic, channel)
+            downlinks.append((endpoint.cloud, default, topics))
+        return downlinks
+
+    @property
+    def dispatcher(self):
+        """downlink dispatcher, routes from `downlink_config`, unmatched messages are written to their channel."""
+        dispatcher = getattr(self, '__dispatcher__', None)
+        if dispatcher is None:
+            downlink_config = self.config.get('downlink_config', {})
+            dispatcher = Dispatcher(
+                default={'handler': 'uart'},
+                control_queue=downlink_config.get('control_queue', 16),
+                data_queue=downlink_config.get('data_queue', 64)
+            )
+            dispatcher.register('uart', self.__uart_handler)
+            dispatcher.register('config', self.__config_handler)
+            dispatcher.register('ota', self.__ota_handler)
+            dispatcher.register('status', self.__status_handler)
+            for route in downlink_config.get('routes', []):
+                dispatcher.add_route(route)
+            setattr(self, '__dispatcher__', dispatcher)
+        return dispatcher
+
+    @property
+    def tracers(self):
+        """(uplink, downlink) hop latency tracers, `trace_config.sample_every` is read on first use."""
+        tracers = getattr(self, '__tracers__', None)
+        if tracers is None:
+            sample_every = self.config.get('trace_config', {}).get('sample_every', 0)
+            tracers = (
+                # uart: first byte -> frame read, enqueue: read -> queued, queue: queued -> dequeued, send: net write
+                Tracer('dtu.up', ('uart', 'enqueue', 'queue', 'send'), sample_every=sample_every),
+                # queue: received from cloud -> dequeued, write: uart write
+                Tracer('dtu.down', ('queue', 'write'), sample_every=sample_every)
+            )
+            setattr(self, '__tracers__', tracers)
+        return tracers
+
+    def latency(self):
+        """hop latency percentiles (ms) of both directions, see `Tracer.summary`."""
+        up, down = self.tracers
+        return {'up': up.summary(), 'down': down.summary()}
 
     def run(self):
+        """start the worker threads, ValueError if the configuration needs more than `system_config.max_threads`.
+
+        the budget is checked once here and covers every thread the DTU and its clouds start (readers, sender,
+        downlinks, cloud listen/reconnect/coalescer threads, spool, metrics, health check, config save, dispatcher
+        lanes), the log dispatcher and application threads are not counted.
+        """
         logger.info('{} run forever.'.format(self))
-        # 启动上行数据处理线程
-        logger.info('start up transaction worker thread {}.'.format(Thread.get_current_thread_ident()))
-        Thread(target=self.up_transaction_handler).start()
-        # 启动下行数据处理线程
-        logger.info('start down transaction worker thread {}.'.format(Thread.get_current_thread_ident()))
-        Thread(target=self.down_transaction_handler).start()
-
-    def down_transaction_handler(self):
+        self.__up_tracer, self.__down_tracer = self.tracers
+        downlinks = self.__downlinks()
+        # 线程预算：每路串口一个读取线程，每个云端连接一个下行线程及其自身的监听/重连/合包线程，
+        # 另加发送/补发/指标上报/健康检查/配置保存线程及两个下行分发线程
+        metrics_enabled = self.config.get('metrics_config', {}).get('enable', False)
+        health_check = any(endpoint.backup is not None for endpoint in self.router.endpoints)
+        cloud_threads = sum(endpoint.cloud.threads for endpoint in self.router.endpoints)
+        needed = len(self.channels) + len(downlinks) + cloud_threads + 1 + (self.spool is not None) \
+            + bool(metrics_enabled) + health_check + 1 + 2
+        max_threads = self.config.get('system_config', {}).get('max_threads', self.MAX_THREADS)
+        if needed > max_threads:
+            raise ValueError('{} channels need {} threads, exceeds max_threads {}.'.format(
+                len(self.channels), needed, max_threads
+            ))
+        self.__check_routes()
+        # 启动上行串口读取线程
+        for channel in self.channels:
+            logger.info('start up transaction worker thread for {}.'.format(channel))
+            Thread(target=self.up_transaction_handler, args=(channel,)).start()
+        # 启动上行云端发送线程
+        logger.info('start send transaction worker thread.')
+        Thread(target=self.send_transaction_handler).start()
+        # 启动下行数据处理线程（控制命令与透传数据分别由两个分发线程处理）
+        self.dispatcher.start()
+        for cloud, default, topics in downlinks:
+            logger.info('start down transaction worker thread for {}.'.format(default))
+            Thread(target=self.down_transaction_handler, args=(cloud, default, topics)).start()
+        # 启动离线缓存补发线程
+        if self.spool is not None:
+            logger.info('start spool transaction worker thread.')
+            Thread(target=self.spool_transaction_handler).start()
+        # 启动运行指标定时上报线程
+        if metrics_enabled:
+            logger.info('start metrics report worker thread.')
+            Thread(target=self.metrics_report_handler).start()
+
+    def down_transaction_handler(self, cloud, default, topics):
+        # only classifies messages, the handlers run on the dispatcher lanes so this never waits on a uart.
         while True:
             try:
-                msg = self.cloud.recv()
-                logger.info('down transfer msg: {}'.format(msg['data']))
-                self.serial.write(msg['data'])
+                msg = cloud.recv()
+                topic = msg.get('topic')
+                if isinstance(topic, bytes):
+                    topic = topic.decode()
+                msg['cloud'] = cloud
+                msg['channel'] = topics.get(topic, default)
+                self.dispatcher.dispatch(msg)
             except Exception as e:
+                self.__down_errors.inc()
                 logger.error('down transfer error: {}'.format(e))
 
-    def up_transaction_handler(self):
+    def __reply(self, msg, route, obj):
+        # mqtt replies are published to the `reply` publish key, tcp replies are a line starting with `reply`
+        # (default the route prefix).
+        cloud = msg['cloud']
+        if isinstance(cloud, MqttIot):
+            if 'reply' in route:
+                cloud.send(route['reply'], ujson.dumps(obj))
+        else:
+            cloud.send('{}{}\n'.format(route.get('reply', route.get('prefix', '')), ujson.dumps(obj)).encode())
+
+    def __uart_handler(self, msg, payload, route):
+        dequeued = utime.ticks_ms()
+        channel = msg['channel']
+        if 'channel' in route:
+            for item in self.channels:
+                if route['channel'] in (item.name, item.index):
+                    channel = item
+                    break
+            else:
+                raise ValueError('channel \"{}\" not configured.'.format(route['channel']))
+        logger.infof('down transfer msg to %s: %s', channel, payload)
+        channel.serial.write(payload)
+        self.__down_tracer.record(msg.get('stamp', dequeued), dequeued, utime.ticks_ms())
+        self.__down_msgs.inc()
+        self.__down_bytes.inc(len(payload))
+
+    def __config_handler(self, msg, payload, route):
+        # payload: {"dotted.key": value, ...}, saved to flash and applied on the next start.
+        items = ujson.loads(bytes(payload))
+        for key, value in items.items():
+            self.config.set(key, value)
+        self.config.save()
+        logger.info('config updated: {}'.format(list(items.keys())))
+        self.__reply(msg, route, {'config': 'ok', 'keys': list(items.keys())})
+
+    def __ota_handler(self, msg, payload, route):
+        # payload: {"files": [{"url": ..., "file_name": "/usr/dtu.py"}, ...], "reboot": true}
+        request = ujson.loads(bytes(payload))
+        fota = app_fota.new()
+        failed = fota.bulk_download(request['files'])
+        if failed:
+            logger.error('ota download failed: {}'.format(failed))
+            self.__reply(msg, route, {'ota': 'failed', 'files': failed})
+            return
+        fota.set_update_flag()
+        self.__reply(msg, route, {'ota': 'ok'})
+        if request.get('reboot', True):
+            logger.warn('ota downloaded, restart.')
+            # a config change may still wait for its debounced save.
+            self.config.flush()
+            Power.powerRestart()
+
+    def __status_handler(self, msg, payload, route):
+        router = self.router
+        self.__reply(msg, route, {
+            'name': self.name,
+            'channels': [channel.name for channel in self.channels],
+            'clouds': {
+                endpoint.name: {'active': router.active(endpoint.name), 'ok': endpoint.is_status_ok()}
+                for endpoint in router.endpoints
+            },
+            'uplink_queue': self.uplink_queue.size(),
+            'spool': self.spool.size() if self.spool is not None else 0,
+        })
+
+    def __check_routes(self):
+        # a missing publish key would fail every send of the channel, refuse to start instead.
+        router = self.router
+        for channel in self.channels:
+            for target in channel.targets:
+                for name in (target, router.backup(target)):
+                    if name is None:
+                        continue
+                    cloud = router.get(name)
+                    if isinstance(cloud, MqttIot) and channel.publish not in cloud.publish_topic:
+                        raise ValueError('{} publishes to \"{}\", not in the publish topics of \"{}\".'.format(
+                            channel, channel.publish, name
+                        ))
+
+    def __send(self, channel, data):
+        """send `data` on the channel's route.
+
+        True when sent, False when it may still go through later (offline, window full, ...) and the caller keeps
+        `data`, None when it never will (configuration or size error), the record is then counted and dropped.
+        """
+        try:
+            # fan-out hands the same memoryview to every endpoint, nothing is copied per destination.
+            return self.router.send(channel.targets, data, topic=channel.publish) is not False
+        except (KeyError, ValueError, TypeError) as e:
+            self.__up_rejected.inc()
+            logger.error('{} send rejected, {} bytes dropped: {}'.format(channel, len(data), e))
+            return None
+        except Exception as e:
+            logger.error('{} send error: {}'.format(channel, e))
+            return False
+
+    def __spool_append(self, tagged):
+        self.__up_spooled.inc()
+        self.spool.append(tagged)
+
+    def __spill_put(self, channel, data, origin, mark):
+        # spool the oldest queued records until `data` fits, the spool then holds everything older than the queue.
+        queue = self.uplink_queue
+        with self.__spill_lock:
+            if self.__spill_buf is None or len(self.__spill_buf) < len(self.__tx_buf):
+                self.__spill_buf = bytearray(len(self.__tx_buf))
+            view = memoryview(self.__spill_buf)
+            while not queue.put(data, channel=channel.index, origin=origin, mark=mark):
+                size = queue.get_into(view[1:], block=False)
+                self.__spill_buf[0] = queue.last_channel
+                self.__spool_append(view[:size + 1])
+                self.__up_spilled.inc()
+
+    def up_transaction_handler(self, channel):
         while True:
             try:
-                data = self.serial.read(1024)
-                if data:
-                    logger.info('up transfer msg: {}'.format(data))
-                    if isinstance(self.cloud, SocketIot):
-                        msg = [data]
-                    elif isinstance(self.cloud, MqttIot):
-                        msg = ['up', data]
-                    else:
-                        raise TypeError('unknow cloud type.')
-                    self.cloud.send(*msg)
+                n = channel.framer.read_frame(channel.up_view[1:])
+                if n:
+                    read = utime.ticks_ms()
+                    origin = channel.serial.take_rx_stamp()
+                    data = channel.up_view[1:n + 1]
+                    self.__up_frames.inc()
+                    self.__up_bytes.inc(n)
+                    if logger.isEnabledFor(Level.INFO):
+                        logger.infof('up transfer msg from %s: %s', channel, bytes(data))
+                    queue = self.uplink_queue
+                    if self.__spill and self.spool is not None and queue.free() < ByteQueue.HEADER_SIZE + n:
+                        self.__spill_put(channel, data, origin, read)
+                    elif not queue.put(data, channel=channel.index, origin=origin, mark=read):
+                        self.__up_dropped.inc()
+                        logger.warn('uplink queue full, drop {} bytes.'.format(n))
             except Exception as e:
+                # e.g. the uart failed to open, retried after a pause instead of spinning.
                 logger.error('up transfer error: {}'.format(e))
+                utime.sleep(1)
+
+    def send_transaction_handler(self):
+        queue = self.uplink_queue
+        while True:
+            try:
+                queue.wait()
+                with self.__spill_lock:
+                    try:
+                        n = queue.get_into(self.__tx_view[1:], block=False)
+                    except ByteQueue.Empty:
+                        continue  # a reader spilled everything to the spool
+                    self.__send_record(queue, n)
+            except Exception as e:
+                logger.error('send transfer error: {}'.format(e))
+
+    def __send_record(self, queue, n):
+        dequeued = utime.ticks_ms()
+        self.__tx_buf[0] = queue.last_channel
+        channel = self.channels[queue.last_channel]
+        data = self.__tx_view[1:n + 1]
+        if self.spool is not None and not self.spool.empty():
+            # keep order, new data queues up behind the spooled backlog.
+            self.__spool_append(self.__tx_view[:n + 1])
+            return
+        rv = self.__send(channel, data)
+        if rv:
+            # also feeds the `dtu.up.send_ms` histogram.
+            self.__up_tracer.record(queue.last_origin, queue.last_mark, queue.last_stamp, dequeued, utime.ticks_ms())
+        elif rv is False:
+            self.__up_send_failed.inc()
+            if self.spool is not None:
+                logger.warn('cloud offline, spool {} bytes.'.format(n))
+                self.__spool_append(self.__tx_view[:n + 1])
+
+    def spool_transaction_handler(self):
+        channels = self.channels
+        router = self.router
+        while True:
+            try:
+                if self.spool.empty() or not any(router.is_status_ok(channel.targets[0]) for channel in channels):
+                    utime.sleep(1)
+                    continue
+                records = self.spool.read_batch(self.__spool_batch)
+                done = 0  # records sent or dropped
+                for record in records:
+                    channel = channels[record[0]] if record[0] < len(channels) else channels[0]
+                    if not router.is_status_ok(channel.targets[0]):
+                        break
+                    if self.__send(channel, record[1:]) is False:
+                        # refused although the cloud is online, a record that keeps failing must not stall the
+                        # backlog behind it forever.
+                        self.__spool_attempts += 1
+                        if self.__spool_attempts < self.MAX_SPOOL_ATTEMPTS:
+                            break
+                        self.__up_rejected.inc()
+                        logger.error('spooled record of {} bytes failed {} times, dropped.'.format(
+                            len(record) - 1, self.__spool_attempts
+                        ))
+                    self.__spool_attempts = 0
+                    done += 1
+                if done:
+                    self.spool.commit(done)
+                    logger.infof('spool drained %d records.', done)
+                else:
+                    # the head record's cloud is still offline, or it is retried.
+                    utime.sleep(1)
+            except Exception as e:
+                logger.error('spool transfer error: {}'.format(e))
+                utime.sleep(1)
+
+    def metrics_report_handler(self):
+        metrics_config = self.config.get('metrics_config', {})
+        interval = metrics_config.get('interval', 300)
+        while True:
+            utime.sleep(interval)
+            try:
+                report = ujson.dumps(Metrics().snapshot())
+                name = metrics_config.get('cloud', self.__default_endpoint)
+                cloud = self.router.get(self.router.active(name))
+                if isinstance(cloud, MqttIot):
+                    cloud.send(metrics_config.get('topic', 'metrics'), report)
+                else:
+                    # tcp 透传链路上以前缀区分指标帧与串口数据
+                    cloud.send('{}{}\n'.format(metrics_config.get('prefix', '$METRICS '), report).encode())
+            except Exception as e:
+                logger.error('metrics report error: {}'.format(e))
@@ -0,0 +1,91 @@
+from usr.logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class Framer(object):
+    """split the serial byte stream into frames before they are forwarded to the cloud.
+
+    modes:
+        none - pass-through, forward whatever the uart has buffered (legacy behaviour).
+        idle - a frame ends when the line stays idle for `idle_chars` character times (3.5 for Modbus RTU)
+            or `idle_ms` milliseconds if given.
+        delimiter - a frame ends with `delimiter` (str or bytes), the delimiter is kept in the frame.
+        fixed - every frame is exactly `length` bytes.
+    in every mode a frame is cut at `max_length` bytes.
+    """
+    MODES = ('none', 'idle', 'delimiter', 'fixed')
+
+    def __init__(self, serial, mode='none', max_length=1024, idle_chars=3.5, idle_ms=None, delimiter=None, length=None):
+        if mode not in self.MODES:
+            raise ValueError('framing mode \"{}\" not supported, choose from {}.'.format(mode, self.MODES))
+        if mode == 'delimiter' and not delimiter:
+            raise ValueError('framing mode \"delimiter\" needs a \"delimiter\".')
+        if mode == 'fixed' and not (length and length > 0):
+            raise ValueError('framing mode \"fixed\" needs a positive \"length\".')
+        self.__serial = serial
+        self.__mode = mode
+        self.__max_length = min(max_length, serial.rx_buffer.capacity)
+        if idle_ms is None:
+            idle_ms = max(1, (int(idle_chars * serial.char_time_us) + 999) // 1000)
+        self.__idle_timeout = idle_ms / 1000
+        if isinstance(delimiter, str):
+            delimiter = delimiter.encode()
+        self.__delimiter = delimiter
+        self.__length = length
+        self.__scanned = 0
+
+    def __repr__(self):
+        return '<Framer {} max_length={}>'.format(self.__mode, self.__max_length)
+
+    @property
+    def mode(self):
+        return self.__mode
+
+    def read_frame(self, buf):
+        """block until one frame is available, copy it into the writable buffer `buf` and return its length."""
+        if self.__mode == 'none':
+            return self.__serial.readinto(buf)
+        limit = min(self.__max_length, len(buf))
+        if self.__mode == 'idle':
+            size = self.__wait_idle(limit)
+        elif self.__mode == 'delimiter':
+            size = self.__wait_delimiter(limit)
+        else:
+            size = self.__wait_fixed(min(self.__length, limit))
+        return self.__serial.rx_buffer.readinto(memoryview(buf)[:size])
+
+    def __wait_idle(self, limit):
+        rx = self.__serial.rx_buffer
+        if len(rx) == 0:
+            self.__serial.fill()
+        while len(rx) < limit:
+            try:
+                self.__serial.fill(timeout=self.__idle_timeout)
+            except self.__serial.TimeoutError:
+                break
+        return min(len(rx), limit)
+
+    def __wait_delimiter(self, limit):
+        rx = self.__serial.rx_buffer
+        while True:
+            index = rx.find(self.__delimiter, self.__scanned)
+            if index >= 0:
+                size = index + len(self.__delimiter)
+                if size <= limit:
+                    self.__scanned = 0
+                    return size
+            if len(rx) >= limit:
+                logger.warn('no delimiter within {} bytes, cut frame.'.format(limit))
+                self.__scanned = 0
+                return limit
+            # the tail may hold a partial delimiter, rescan it once more bytes arrive.
+            self.__scanned = max(0, len(rx) - len(self.__delimiter) + 1)
+            self.__serial.fill()
+
+    def __wait_fixed(self, size):
+        rx = self.__serial.rx_buffer
+        while len(rx) < size:
+            self.__serial.fill()
+        return size
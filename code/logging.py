@@ -1,7 +1,9 @@
+import uos
 import utime
 import _thread
 import usys as sys
 import uio as io
+from usr.threading import Queue, Thread
 
 
 class Level(object):
@@ -45,10 +47,12 @@ def getNameLevel(name):
 class BasicConfig(object):
     logger_register_table = {}
     lock = _thread.allocate_lock()
+    generation = 0  # bumped on every change, loggers refresh their cached settings when it moves
     basic_configure = {
         'level': Level.WARN,
         'debug': True,
-        'stream': sys.stdout
+        'stream': sys.stdout,
+        'dispatcher': None
     }
 
     @classmethod
@@ -67,6 +71,7 @@ class BasicConfig(object):
         if level is not None:
             kwargs['level'] = getNameLevel(level)
         with cls.lock:
+            cls.generation += 1
             return cls.basic_configure.update(kwargs)
 
     @classmethod
@@ -74,42 +79,112 @@ class BasicConfig(object):
         with cls.lock:
             return cls.basic_configure[key]
 
+    @classmethod
+    def add_handler(cls, handler, capacity=64, batch=16):
+        """route records to `handler` through the background dispatcher instead of printing them synchronously.
+
+        `capacity` and `batch` size the dispatcher ring, they only apply when the first handler is added.
+        """
+        with cls.lock:
+            dispatcher = cls.basic_configure['dispatcher']
+            if dispatcher is None:
+                dispatcher = Dispatcher(capacity=capacity, batch=batch)
+                cls.basic_configure['dispatcher'] = dispatcher
+                cls.generation += 1
+        dispatcher.add_handler(handler)
+        return handler
+
     @classmethod
     def set(cls, key, value):
         if key == 'level':
             value = getNameLevel(value)
         with cls.lock:
+            cls.generation += 1
             cls.basic_configure[key] = value
 
 
 class Logger(object):
+    __time_cache = [None, '']  # [second, formatted], shared by all loggers
 
     def __init__(self, name):
         self.name = name
+        self.level = None  # per-logger level, overrides `BasicConfig` level when not in debug mode
+        self.__generation = -1
+        self.__effective_level = Level.DEBUG
+        self.__stream = None
+        self.__dispatcher = None
 
-    @staticmethod
-    def __get_formatted_time():
-        # (2023, 9, 30, 11, 11, 41, 5, 273)
-        cur_time_tuple = utime.localtime()
-        return '{}-{}-{} {}:{}:{}'.format(
-            cur_time_tuple[0],
-            cur_time_tuple[1],
-            cur_time_tuple[2],
-            cur_time_tuple[3],
-            cur_time_tuple[4],
-            cur_time_tuple[5]
-        )
+    @classmethod
+    def __get_formatted_time(cls):
+        # formatted once per second, records in the same second reuse it.
+        now = utime.time()
+        cache = cls.__time_cache
+        if cache[0] != now:
+            # (2023, 9, 30, 11, 11, 41, 5, 273)
+            cur_time_tuple = utime.localtime(now)
+            cache[1] = '{}-{}-{} {}:{}:{}'.format(
+                cur_time_tuple[0],
+                cur_time_tuple[1],
+                cur_time_tuple[2],
+                cur_time_tuple[3],
+                cur_time_tuple[4],
+                cur_time_tuple[5]
+            )
+            cache[0] = now
+        return cache[1]
+
+    def __refresh(self):
+        if self.__generation == BasicConfig.generation:
+            return
+        with BasicConfig.lock:
+            config = BasicConfig.basic_configure
+            if config['debug']:
+                self.__effective_level = Level.DEBUG
+            elif self.level is not None:
+                self.__effective_level = self.level
+            else:
+                self.__effective_level = config['level']
+            self.__stream = config['stream']
+            self.__dispatcher = config['dispatcher']
+            self.__generation = BasicConfig.generation
+
+    def setLevel(self, level):
+        self.level = getNameLevel(level) if isinstance(level, str) else level
+        self.__generation = -1
+
+    def isEnabledFor(self, level):
+        self.__refresh()
+        return level >= self.__effective_level
 
     def log(self, level, *message):
-        if not BasicConfig.get('debug'):
-            if level < BasicConfig.get('level'):
-                return
-        stream = BasicConfig.get('stream')
+        """emit `message` parts separated by spaces."""
+        self.__refresh()
+        if level < self.__effective_level:
+            return
+        self.__emit(level, message)
+
+    def logf(self, level, fmt, *args):
+        """emit `fmt % args`, formatted only when the record passes the level check."""
+        self.__refresh()
+        if level < self.__effective_level:
+            return
+        try:
+            message = fmt % args
+        except (TypeError, ValueError) as e:
+            # a bad format must not raise into the calling (data path) thread.
+            message = '{} {} (format error: {})'.format(fmt, args, e)
+        self.__emit(level, (message,))
+
+    def __emit(self, level, message):
         prefix = '[{}][{}][{}]'.format(
             self.__get_formatted_time(),
             self.name,
             getLevelName(level)
         )
+        if self.__dispatcher is not None:
+            self.__dispatcher.put(' '.join([prefix] + [str(item) for item in message]))
+            return
+        stream = self.__stream
         print(prefix, *message, file=stream)
         if isinstance(stream, io.TextIOWrapper):
             stream.flush()
@@ -129,6 +204,158 @@ class Logger(object):
     def critical(self, *message):
         self.log(Level.CRITICAL, *message)
 
+    def debugf(self, fmt, *args):
+        self.logf(Level.DEBUG, fmt, *args)
+
+    def infof(self, fmt, *args):
+        self.logf(Level.INFO, fmt, *args)
+
+    def warnf(self, fmt, *args):
+        self.logf(Level.WARN, fmt, *args)
+
+    def errorf(self, fmt, *args):
+        self.logf(Level.ERROR, fmt, *args)
+
+    def criticalf(self, fmt, *args):
+        self.logf(Level.CRITICAL, fmt, *args)
+
+
+class Handler(object):
+    """sink for formatted records, `emit_batch` is called from the dispatcher thread."""
+
+    def emit_batch(self, lines):
+        raise NotImplementedError('handler should implement this method to output records')
+
+    def close(self):
+        pass
+
+
+class StreamHandler(Handler):
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def emit_batch(self, lines):
+        stream = self.stream or BasicConfig.get('stream')
+        for line in lines:
+            print(line, file=stream)
+        if isinstance(stream, io.TextIOWrapper):
+            stream.flush()
+
+
+class RotatingFileHandler(Handler):
+    """append records to `path`, rotated to `path.1` ... `path.<backup_count>` once it exceeds `max_bytes`."""
+
+    def __init__(self, path, max_bytes=16384, backup_count=2):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.__file = None
+        self.__size = 0
+
+    def __open(self):
+        self.__file = open(self.path, 'a')
+        try:
+            self.__size = uos.stat(self.path)[6]
+        except OSError:
+            self.__size = 0
+
+    def __rotate(self):
+        self.close()
+        for i in range(self.backup_count, 0, -1):
+            src = self.path if i == 1 else '{}.{}'.format(self.path, i - 1)
+            dst = '{}.{}'.format(self.path, i)
+            try:
+                uos.remove(dst)
+            except OSError:
+                pass
+            try:
+                uos.rename(src, dst)
+            except OSError:
+                pass
+        if self.backup_count <= 0:
+            uos.remove(self.path)
+
+    def emit_batch(self, lines):
+        if self.__file is None:
+            self.__open()
+        for line in lines:
+            self.__size += self.__file.write(line + '\n')
+        self.__file.flush()
+        if self.__size >= self.max_bytes:
+            self.__rotate()
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+
+class MemoryRingHandler(Handler):
+    """keep the last `capacity` records in RAM, e.g. to dump them after a fault."""
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.__lines = [None] * capacity
+        self.__head = 0
+        self.__count = 0
+        self.__lock = _thread.allocate_lock()
+
+    def emit_batch(self, lines):
+        with self.__lock:
+            for line in lines:
+                self.__lines[(self.__head + self.__count) % self.capacity] = line
+                if self.__count < self.capacity:
+                    self.__count += 1
+                else:
+                    self.__head = (self.__head + 1) % self.capacity
+
+    def records(self, n=None):
+        """last `n` (default all kept) records, oldest first."""
+        with self.__lock:
+            n = self.__count if n is None else min(n, self.__count)
+            start = self.__head + self.__count - n
+            return [self.__lines[(start + i) % self.capacity] for i in range(n)]
+
+
+class Dispatcher(object):
+    """bounded ring of formatted records drained in batches to the handlers by a background thread.
+
+    `put` never blocks the logging thread, records are counted in `dropped` when the ring is full.
+    """
+
+    def __init__(self, capacity=64, batch=16):
+        self.__queue = Queue(max_size=capacity)
+        self.__batch = batch
+        self.__handlers = []
+        self.__dropped = 0
+        self.__thread = Thread(target=self.__worker)
+        self.__thread.start()
+
+    def add_handler(self, handler):
+        self.__handlers.append(handler)
+
+    @property
+    def dropped(self):
+        return self.__dropped
+
+    def put(self, line):
+        try:
+            self.__queue.put(line, block=False)
+        except Queue.Full:
+            self.__dropped += 1
+            return False
+        return True
+
+    def __worker(self):
+        while True:
+            lines = self.__queue.get_many(self.__batch)
+            for handler in self.__handlers:
+                try:
+                    handler.emit_batch(lines)
+                except Exception as e:
+                    sys.print_exception(e)
+
 
 def getLogger(name):
     return BasicConfig.getLogger(name)
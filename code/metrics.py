@@ -0,0 +1,155 @@
+import uarray
+from usr.utils import Singleton
+from usr.threading import Lock
+
+
+class Counter(object):
+    """monotonic counter. increments are not locked, a rare lost update under contention is accepted."""
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def reset(self):
+        self.value = 0
+
+
+class Gauge(object):
+    """current value, either `set` explicitly or read from `fn` when sampled."""
+
+    def __init__(self, name, fn=None):
+        self.name = name
+        self.__fn = fn
+        self.__value = 0
+
+    @property
+    def fn(self):
+        return self.__fn
+
+    def bind(self, fn):
+        self.__fn = fn
+
+    def set(self, value):
+        self.__value = value
+
+    @property
+    def value(self):
+        if self.__fn is not None:
+            return self.__fn()
+        return self.__value
+
+
+class Histogram(object):
+    """fixed-bucket histogram, counts live in one preallocated array so `observe` does not allocate.
+
+    `bounds` are the inclusive upper bounds of the buckets, values above the last bound go to an overflow bucket.
+    percentiles are approximated by the upper bound of the bucket they fall in.
+    """
+    DEFAULT_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self, name, bounds=DEFAULT_BOUNDS):
+        self.name = name
+        self.bounds = tuple(bounds)
+        self.__counts = uarray.array('L', [0] * (len(self.bounds) + 1))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.__lock = Lock()
+
+    def observe(self, value):
+        index = len(self.bounds)
+        for i in range(index):
+            if value <= self.bounds[i]:
+                index = i
+                break
+        with self.__lock:
+            self.__counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        """approximate `p` percentile (0~100), None if nothing was observed."""
+        with self.__lock:
+            if self.count == 0:
+                return None
+            rank = self.count * p / 100
+            seen = 0
+            for i in range(len(self.__counts)):
+                seen += self.__counts[i]
+                if seen >= rank and seen > 0:
+                    return self.bounds[i] if i < len(self.bounds) else self.max
+            return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+    def reset(self):
+        with self.__lock:
+            for i in range(len(self.__counts)):
+                self.__counts[i] = 0
+            self.count = 0
+            self.total = 0
+            self.max = 0
+
+
+@Singleton
+class Metrics(object):
+    """process wide registry, `counter`/`gauge`/`histogram` return the existing metric when the name is taken.
+
+    names are global, objects that can exist more than once (e.g. one cloud connection per endpoint) put an instance
+    name into theirs. registering a gauge name again rebinds it to the new `fn`, so an object re-created after a
+    failure reports its own value instead of the dead one's.
+    """
+
+    def __init__(self):
+        self.__counters = {}
+        self.__gauges = {}
+        self.__histograms = {}
+        self.__lock = Lock()
+
+    def __get_or_create(self, table, name, factory):
+        metric = table.get(name)
+        if metric is None:
+            with self.__lock:
+                metric = table.get(name)
+                if metric is None:
+                    metric = factory()
+                    table[name] = metric
+        return metric
+
+    def counter(self, name):
+        return self.__get_or_create(self.__counters, name, lambda: Counter(name))
+
+    def gauge(self, name, fn=None):
+        gauge = self.__get_or_create(self.__gauges, name, lambda: Gauge(name, fn=fn))
+        if fn is not None and gauge.fn != fn:
+            gauge.bind(fn)
+        return gauge
+
+    def histogram(self, name, bounds=Histogram.DEFAULT_BOUNDS):
+        return self.__get_or_create(self.__histograms, name, lambda: Histogram(name, bounds=bounds))
+
+    def snapshot(self):
+        gauges = {}
+        for name, gauge in self.__gauges.items():
+            try:
+                gauges[name] = gauge.value
+            except Exception:
+                gauges[name] = None
+        return {
+            'counters': {name: counter.value for name, counter in self.__counters.items()},
+            'gauges': gauges,
+            'histograms': {name: histogram.summary() for name, histogram in self.__histograms.items()},
+        }
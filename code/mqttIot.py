@@ -1,14 +1,153 @@
+import uos
 import utime
+import ql_fs
+import ustruct
 from umqtt import MQTTClient
-from usr import network
 from usr.logging import getLogger
 from usr.threading import Queue, Thread, Condition, Lock
 from usr.cloud_abc import CloudABC
+from usr.reconnect import ReconnectManager
+from usr.socketIot import DnsCache
+from usr.metrics import Metrics
+from usr.codec import Envelope
 
 
 logger = getLogger(__name__)
 
 
+def _remaining_length(n):
+    # MQTT variable length encoding, 7 bits per byte, high bit set while more bytes follow.
+    rv = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        rv.append(byte | 0x80 if n else byte)
+        if not n:
+            return rv
+
+
+class Outbound(object):
+    """QoS1 publishes with up to `window` PUBACKs outstanding instead of stop-and-wait.
+
+    PUBLISH packets are written straight to the client socket with their own packet id, the listen loop reports
+    PUBACKs through `ack`. unacked messages are kept (and with `store_path` also written to flash, one file per
+    packet id) and sent again with the DUP flag by `resend` after a reconnect, so delivery stays at-least-once.
+    """
+    PUBLISH = 0x30
+    PUBACK = 0x40
+    SUBSCRIBE = 0x82
+    SUBACK = 0x90
+    SUBSCRIBE_PID = 0xFFFF  # reserved for `MqttIot`'s batched SUBSCRIBE, publishes use 1 ~ 0xFFFE
+    DUP = 0x08
+    QOS1 = 0x02
+
+    def __init__(self, window=8, store_path=None, timeout=10, name='mqtt'):
+        if window <= 0:
+            raise ValueError('inflight window must be greater than 0.')
+        self.__window = window
+        self.__store_path = store_path
+        self.__timeout = timeout  # seconds `publish` waits for a free slot
+        self.__inflight = {}  # packet id -> (topic, payload)
+        self.__order = []  # packet ids, oldest first
+        self.__pid = 0
+        self.__cond = Condition()
+        self.__write_lock = Lock()
+        metrics = Metrics()
+        self.__retransmits = metrics.counter('{}.retransmits'.format(name))
+        metrics.gauge('{}.inflight'.format(name), self.__len__)
+        if store_path is not None:
+            self.__load()
+
+    def __len__(self):
+        return len(self.__order)
+
+    def __file(self, pid):
+        return '{}/{}.msg'.format(self.__store_path, pid)
+
+    def __load(self):
+        if not ql_fs.path_exists(self.__store_path):
+            ql_fs.mkdirs(self.__store_path)
+            return
+        for name in uos.listdir(self.__store_path):
+            if not name.endswith('.msg'):
+                continue
+            pid = int(name[:-4])
+            with open(self.__file(pid), 'rb') as f:
+                raw = f.read()
+            length = ustruct.unpack_from('<H', raw)[0]
+            self.__inflight[pid] = (raw[2:2 + length], raw[2 + length:])
+            self.__order.append(pid)
+            self.__pid = max(self.__pid, pid)
+        self.__order.sort()
+        if self.__order:
+            logger.info('{} unacked mqtt messages restored.'.format(len(self.__order)))
+
+    def __next_pid(self):
+        while True:
+            self.__pid = self.__pid % 0xFFFE + 1
+            if self.__pid not in self.__inflight:
+                return self.__pid
+
+    @classmethod
+    def packet(cls, topic, payload, pid, dup=False):
+        length = _remaining_length(2 + len(topic) + 2 + len(payload))
+        buf = bytearray(1 + len(length) + 2 + len(topic) + 2 + len(payload))
+        buf[0] = cls.PUBLISH | cls.QOS1 | (cls.DUP if dup else 0)
+        buf[1:1 + len(length)] = length
+        offset = 1 + len(length)
+        ustruct.pack_into('!H', buf, offset, len(topic))
+        buf[offset + 2:offset + 2 + len(topic)] = topic
+        offset += 2 + len(topic)
+        ustruct.pack_into('!H', buf, offset, pid)
+        buf[offset + 2:] = payload
+        return buf
+
+    def __write(self, sock, packet):
+        with self.__write_lock:
+            sock.write(packet)
+
+    def publish(self, sock, topic, payload):
+        """send a QoS1 publish, return its packet id or False if no slot frees up within `timeout`."""
+        topic = topic.encode() if isinstance(topic, str) else topic
+        payload = bytes(payload)  # the caller may reuse its buffer before the PUBACK arrives
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: len(self.__order) < self.__window, timeout=self.__timeout):
+                return False
+            pid = self.__next_pid()
+            self.__inflight[pid] = (topic, payload)
+            self.__order.append(pid)
+        if self.__store_path is not None:
+            with open(self.__file(pid), 'wb') as f:
+                f.write(ustruct.pack('<H', len(topic)))
+                f.write(topic)
+                f.write(payload)
+        self.__write(sock, self.packet(topic, payload, pid))
+        return pid
+
+    def ack(self, pid):
+        with self.__cond:
+            if self.__inflight.pop(pid, None) is None:
+                return False
+            self.__order.remove(pid)
+            self.__cond.notify_all()
+        if self.__store_path is not None:
+            try:
+                uos.remove(self.__file(pid))
+            except OSError:
+                pass
+        return True
+
+    def resend(self, sock):
+        """send every unacked message again, oldest first, with the DUP flag."""
+        with self.__cond:
+            pending = [(pid, self.__inflight[pid]) for pid in self.__order]
+        for pid, (topic, payload) in pending:
+            self.__write(sock, self.packet(topic, payload, pid, dup=True))
+            self.__retransmits.inc()
+        if pending:
+            logger.info('resent {} unacked mqtt messages.'.format(len(pending)))
+
+
 class MqttIot(CloudABC):
 
     def __init__(self, *args, **kwargs):
@@ -31,72 +170,174 @@ class MqttIot(CloudABC):
                 整数类型 0：发送者只发送一次消息，不进行重试 1：发送者最少发送一次消息，确保消息到达Broker。
             subscribe - 订阅主题。
             publish - 发布主题。
+            reconnect - （可选）重连退避参数，字典类型，如 {"base_delay": 1, "max_delay": 300}，见 `ReconnectManager`。
+            inflight_window - （可选）qos 为 1 时允许同时等待 PUBACK 的消息数，默认 0 与 1 相同，即逐条等待确认。
+            outbound_store - （可选）未确认消息的 flash 存储目录，断电重启后补发，默认不存储。
+            codec - （可选）上下行消息编解码，如 "zlib"、"lzf" 或 {"name": "lzf", "dictionary": "..."}，见 `usr.codec`。
+            name - （可选）连接名称，用于区分多个连接的指标名（如 `mqtt.<name>.sent`），默认不区分。
         """
         self.args = args
         self.kwargs = kwargs
+        name = self.kwargs.pop('name', None)
+        self.__name = 'mqtt' if name is None else 'mqtt.{}'.format(name)
         self.clean_session = self.kwargs.pop('clean_session', True)
         self.qos = self.kwargs.pop('qos', 0)
         self.subscribe_topic = self.kwargs.pop('subscribe', {})
         self.publish_topic = self.kwargs.pop('publish', {})
+        window = self.kwargs.pop('inflight_window', 0)
+        store_path = self.kwargs.pop('outbound_store', None)
+        self.__outbound = None
+        if self.qos == 1:
+            # every qos 1 publish goes through `Outbound`: the listen loop reads all PUBACKs, umqtt's own stop-and-wait
+            # publish would race it for them.
+            self.__outbound = Outbound(max(window, 1), store_path=store_path, name=self.__name)
+        codec = self.kwargs.pop('codec', None)
+        self.__envelope = None
+        if codec is not None:
+            self.__envelope = Envelope(codec, name='codec' if name is None else 'codec.{}'.format(name))
         self.__queue = Queue()
         self.kwargs.setdefault('reconn', False)  # 禁用内部重连机制
-        self.__cli = None
+        self.__cli = None  # created once and reconnected in place
+        self.__connected = False
+        self.session_present = False  # broker kept the session (and subscriptions) at the last connect
         self.__listen_thread = Thread(target=self.__listen_thread_worker)
-        self.__reconn_thread = Thread(target=self.__reconnect)
-        self.__reconn_cond = Condition()
-        self.__reconn_mutex = Lock()
+        self.__reconn = ReconnectManager(
+            self.__name, self.connect, disconnect=self.__disconnect, resolve=self.__resolve,
+            **self.kwargs.pop('reconnect', {})
+        )
+        metrics = Metrics()
+        self.__sent = metrics.counter('{}.sent'.format(self.__name))
+        self.__send_failed = metrics.counter('{}.send_failed'.format(self.__name))
+        self.__received = metrics.counter('{}.received'.format(self.__name))
+        metrics.gauge('{}.reconnects'.format(self.__name), lambda: self.__reconn.stats()['reconnects'])
+        metrics.gauge('{}.recv_queue'.format(self.__name), self.__queue.size)
 
     def __callback(self, topic, data):
-        self.__queue.put({'topic': topic, 'data': data})
+        self.__received.inc()
+        if self.__envelope is not None:
+            try:
+                data = bytes(self.__envelope.decode(data))
+            except Exception as e:
+                logger.error('mqtt decode failed, message dropped. {}'.format(e))
+                return
+        self.__queue.put({'topic': topic, 'data': data, 'stamp': utime.ticks_ms()})
 
     def __listen_thread_worker(self):
         while True:
             try:
-                self.__cli.wait_msg()
+                self.__handle(self.__cli.wait_msg())
             except Exception as e:
                 logger.error('mqtt listen error: {}'.format(str(e)))
-                with self.__reconn_cond:
-                    self.reconnect()
-                    self.__reconn_cond.wait_for(self.is_status_ok)
+                self.reconnect()
+                self.__reconn.wait_connected()
+
+    def __read_body(self):
+        # body of a packet whose first byte `wait_msg` already consumed and returned.
+        sock = self.__cli.sock
+        length = 0
+        shift = 0
+        while True:
+            byte = sock.read(1)[0]
+            length |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        return sock.read(length)
+
+    def __handle(self, op):
+        # umqtt dispatches PUBLISH itself and hands other packet types back with their body unread.
+        if op == Outbound.PUBACK:
+            body = self.__read_body()
+            if self.__outbound is not None:  # always set with qos 1, qos 0 gets no PUBACK
+                self.__outbound.ack((body[0] << 8) | body[1])
+        elif op == Outbound.SUBACK:
+            return self.__read_body()
+        elif op is not None:
+            logger.warn('mqtt unexpected packet 0x{:02x}.'.format(op))
+            self.__read_body()
 
     def reconnect(self):
-        with self.__reconn_mutex:
-            self.__reconn_thread.start()
+        self.__reconn.trigger()
 
-    def __reconnect(self):
-        while True:
-            network.wait_network_ready()
-            logger.info('mqtt connecting...')
-            with self.__reconn_cond:
-                self.__disconnect()
-                if self.connect():
-                    self.__reconn_cond.notify_all()
-                    logger.info('mqtt connect successfully.')
-                    break
-                utime.sleep(10)
+    @property
+    def reconnect_stats(self):
+        return self.__reconn.stats()
 
     def __disconnect(self):
+        if self.__cli is None or not self.__connected:
+            return True
+        self.__connected = False
         try:
             self.__cli.disconnect()
-            self.__cli = None
         except Exception as e:
             logger.error('mqtt disconnect failed: {}'.format(e))
             return False
         return True
 
+    def __server_address(self):
+        # 域名经 DnsCache 解析缓存，SSL 连接保留域名。
+        server = self.kwargs.get('server')
+        if server is None or self.kwargs.get('ssl'):
+            return None
+        return server, self.kwargs.get('port') or 1883
+
+    def __resolve(self):
+        address = self.__server_address()
+        if address is not None:
+            try:
+                DnsCache().resolve(*address)
+            except Exception as e:
+                logger.error('mqtt resolve failed. {}'.format(str(e)))
+                return False
+        return True
+
+    def __subscribe(self):
+        # every topic in one SUBSCRIBE packet, one round-trip instead of one per topic.
+        topics = [topic.encode() if isinstance(topic, str) else topic for topic in self.subscribe_topic.values()]
+        if not topics:
+            return
+        body = bytearray(ustruct.pack('!H', Outbound.SUBSCRIBE_PID))
+        for topic in topics:
+            body.extend(ustruct.pack('!H', len(topic)))
+            body.extend(topic)
+            body.append(self.qos)
+        self.__cli.sock.write(bytes([Outbound.SUBSCRIBE]) + _remaining_length(len(body)) + body)
+        while True:
+            suback = self.__handle(self.__cli.wait_msg())
+            if suback is not None and ustruct.unpack_from('!H', suback)[0] == Outbound.SUBSCRIBE_PID:
+                break
+        for i in range(len(topics)):
+            if suback[2 + i] == 0x80:
+                raise ValueError('broker refused topic {}'.format(topics[i]))
+        logger.info('subscribed {} topics.'.format(len(topics)))
+
     def connect(self):
+        address = self.__server_address()
         try:
-            self.__cli = MQTTClient(*self.args, **self.kwargs)
-            self.__cli.connect(clean_session=self.clean_session)
+            if self.__cli is None:
+                kwargs = self.kwargs
+                if address is not None:
+                    kwargs = dict(self.kwargs)
+                    kwargs['server'] = DnsCache().resolve(*address)[1]
+                self.__cli = MQTTClient(*self.args, **kwargs)
+                self.__cli.set_callback(self.__callback)
+            elif address is not None:
+                self.__cli.server = DnsCache().resolve(*address)[1]
+            self.session_present = bool(self.__cli.connect(clean_session=self.clean_session))
         except Exception as e:
             logger.error('mqtt connect failed. {}'.format(str(e)))
+            if address is not None:
+                DnsCache().rotate(*address)
             return False
         else:
+            self.__connected = True
             try:
-                self.__cli.set_callback(self.__callback)
-                for topic in self.subscribe_topic.values():
-                    logger.info('subscribe topic: {}'.format(topic))
-                    self.__cli.subscribe(topic, self.qos)
+                if self.session_present and not self.clean_session:
+                    logger.info('mqtt session resumed, subscriptions kept by the broker.')
+                else:
+                    self.__subscribe()
+                if self.__outbound is not None:
+                    self.__outbound.resend(self.__cli.sock)
             except Exception as e:
                 logger.error('mqtt subscribe failed. {}'.format(str(e)))
                 return False
@@ -107,16 +348,31 @@ class MqttIot(CloudABC):
 
     def close(self):
         self.__listen_thread.stop()
-        self.__reconn_thread.stop()
+        self.__reconn.stop()
         self.__disconnect()
 
+    @property
+    def threads(self):
+        return 2  # listen thread and reconnect thread
+
     def is_status_ok(self):
-        return self.__cli is not None and self.__cli.get_mqttsta() == 0
+        return self.__connected and self.__cli.get_mqttsta() == 0
 
     def send(self, topic_id, data):
         if self.is_status_ok():
-            return self.__cli.publish(self.publish_topic[topic_id], data, qos=self.qos)
+            if self.__envelope is not None:
+                data = self.__envelope.encode(data)
+            if self.__outbound is not None:
+                rv = self.__outbound.publish(self.__cli.sock, self.publish_topic[topic_id], data)
+                if rv is False:
+                    self.__send_failed.inc()
+                    return False
+            else:
+                rv = self.__cli.publish(self.publish_topic[topic_id], data, qos=self.qos)
+            self.__sent.inc()
+            return rv
         else:
+            self.__send_failed.inc()
             self.reconnect()
             return False
 
@@ -6,6 +6,7 @@ import dataCall
 import sys_bus
 from misc import Power
 from usr.logging import getLogger
+from usr.configure import Configure
 
 
 logger = getLogger(__name__)
@@ -60,6 +61,7 @@ def wait_network_ready():
                 cfun_switch()
             if total >= 6:
                 logger.warn('power restart.')
+                Configure().flush()
                 Power.powerRestart()
         total += 1
 
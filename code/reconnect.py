@@ -0,0 +1,151 @@
+import utime
+import urandom
+import sys_bus
+from usr import network
+from usr.logging import getLogger
+from usr.threading import Thread, Condition, Lock
+
+
+logger = getLogger(__name__)
+
+
+class ReconnectManager(object):
+    """reconnect state machine shared by the cloud objects.
+
+    DISCONNECTED -> RESOLVING -> CONNECTING -> CONNECTED
+                        ^             |
+                        +-- BACKOFF <-+
+
+    failed attempts back off exponentially (`base_delay` * `factor` ** n, capped at `max_delay`) with random jitter,
+    so a fleet that lost the cell at the same moment does not retry in lockstep. a data call "connected" event
+    published on `network.NET_STATUS_TOPIC` cuts the backoff short.
+    """
+    DISCONNECTED = 'DISCONNECTED'
+    RESOLVING = 'RESOLVING'
+    CONNECTING = 'CONNECTING'
+    CONNECTED = 'CONNECTED'
+    BACKOFF = 'BACKOFF'
+
+    def __init__(self, name, connect, disconnect=None, resolve=None, base_delay=1, max_delay=300, factor=2, jitter=0.5):
+        """
+        connect - callable returning True once the cloud connection is established.
+        disconnect - (optional) callable releasing the old connection before a new attempt.
+        resolve - (optional) callable returning True once the server address is resolved.
+        jitter - fraction (0~1) of the backoff delay that is randomized.
+        """
+        self.name = name
+        self.__connect = connect
+        self.__disconnect = disconnect
+        self.__resolve = resolve
+        self.__base_delay = base_delay
+        self.__max_delay = max_delay
+        self.__factor = factor
+        self.__jitter = jitter
+        self.__state = self.DISCONNECTED
+        self.__requested = False
+        self.__kick = False
+        self.__failures = 0
+        self.__down_since = None
+        self.__stats = {
+            'attempts': 0,
+            'reconnects': 0,
+            'last_reconnect_ms': 0,
+            'max_reconnect_ms': 0,
+        }
+        self.__cond = Condition()
+        self.__mutex = Lock()
+        self.__thread = Thread(target=self.__run)
+        sys_bus.subscribe(network.NET_STATUS_TOPIC, self.__on_net_status)
+
+    def __repr__(self):
+        return '<ReconnectManager {} {}>'.format(self.name, self.__state)
+
+    @property
+    def state(self):
+        return self.__state
+
+    def stats(self):
+        with self.__cond:
+            return dict(self.__stats)
+
+    def __set_state(self, state):
+        if state != self.__state:
+            logger.debugf('%s %s -> %s', self.name, self.__state, state)
+            self.__state = state
+
+    def __on_net_status(self, topic, args):
+        # dataCall callback args: (profile_id, state, ...), state 1 means the data call is up.
+        if args[1] != 1:
+            return
+        with self.__cond:
+            if self.__state == self.BACKOFF:
+                self.__kick = True
+                self.__cond.notify_all()
+
+    def trigger(self):
+        """report a broken link, a reconnect runs unless one is already in progress."""
+        with self.__cond:
+            self.__requested = True
+            if self.__state == self.CONNECTED:
+                self.__set_state(self.DISCONNECTED)
+            self.__cond.notify_all()
+        with self.__mutex:
+            if not self.__thread.is_running():
+                self.__thread.start()
+
+    def wait_connected(self, timeout=None):
+        with self.__cond:
+            return self.__cond.wait_for(lambda: self.__state == self.CONNECTED, timeout=timeout)
+
+    def stop(self):
+        self.__thread.stop()
+
+    def __next_delay(self):
+        delay = min(self.__max_delay, self.__base_delay * (self.__factor ** self.__failures))
+        return delay * (1 - self.__jitter * urandom.random())
+
+    def __attempt(self):
+        with self.__cond:
+            self.__set_state(self.RESOLVING)
+        network.wait_network_ready()
+        if self.__resolve is not None and not self.__resolve():
+            return False
+        with self.__cond:
+            self.__set_state(self.CONNECTING)
+        self.__stats['attempts'] += 1
+        if self.__disconnect is not None:
+            self.__disconnect()
+        return self.__connect()
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                self.__cond.wait_for(lambda: self.__requested)
+                if self.__down_since is None:
+                    self.__down_since = utime.ticks_ms()
+            logger.info('{} connecting...'.format(self.name))
+            try:
+                ok = self.__attempt()
+            except Exception as e:
+                logger.error('{} reconnect error: {}'.format(self.name, e))
+                ok = False
+            with self.__cond:
+                if ok:
+                    elapsed = utime.ticks_diff(utime.ticks_ms(), self.__down_since)
+                    self.__stats['reconnects'] += 1
+                    self.__stats['last_reconnect_ms'] = elapsed
+                    self.__stats['max_reconnect_ms'] = max(self.__stats['max_reconnect_ms'], elapsed)
+                    self.__failures = 0
+                    self.__down_since = None
+                    self.__requested = False
+                    self.__set_state(self.CONNECTED)
+                    self.__cond.notify_all()
+                    logger.info('{} connect successfully after {} ms.'.format(self.name, elapsed))
+                    continue
+                delay = self.__next_delay()
+                self.__failures += 1
+                self.__kick = False
+                self.__set_state(self.BACKOFF)
+                logger.warn('{} connect failed, retry in {:.1f}s.'.format(self.name, delay))
+                self.__cond.wait_for(lambda: self.__kick, timeout=delay)
+                self.__set_state(self.DISCONNECTED)
@@ -0,0 +1,161 @@
+import utime
+from usr.logging import getLogger
+from usr.threading import Thread, Lock
+from usr.metrics import Metrics
+from usr.mqttIot import MqttIot
+
+
+logger = getLogger(__name__)
+
+
+class Endpoint(object):
+
+    def __init__(self, name, cloud, backup=None):
+        self.name = name
+        self.cloud = cloud
+        self.backup = backup
+        self.failures = 0  # consecutive failed sends
+        self.since = None  # ticks the current health state (down while active, up while failed over) started
+
+    def __repr__(self):
+        return '<Endpoint {}>'.format(self.name)
+
+    def is_status_ok(self):
+        is_status_ok = getattr(self.cloud, 'is_status_ok', None)
+        return True if is_status_ok is None else is_status_ok()
+
+    def send(self, data, topic=None):
+        if isinstance(self.cloud, MqttIot):
+            return self.cloud.send(topic, data)
+        return self.cloud.send(data)
+
+
+class CloudRouter(object):
+    """named cloud connections with fan-out and primary/backup failover.
+
+    `send(names, data)` hands the same `data` object to every destination, the first name is the primary path whose
+    result is returned, the others are best-effort copies. an endpoint with a `backup` fails over when it stays
+    unhealthy for `failover_after` seconds or `max_failures` sends in a row fail, and fails back once it has been
+    healthy again for `failback_after` seconds. health is polled every `health_interval` seconds.
+    """
+
+    def __init__(self, health_interval=5, failover_after=10, failback_after=30, max_failures=3):
+        self.__endpoints = {}
+        self.__active = {}  # endpoint name -> name of the endpoint currently carrying its traffic
+        self.__health_interval = health_interval
+        self.__failover_after = failover_after * 1000
+        self.__failback_after = failback_after * 1000
+        self.__max_failures = max_failures
+        self.__lock = Lock()
+        self.__health_thread = Thread(target=self.__health_thread_worker)
+        metrics = Metrics()
+        self.__failovers = metrics.counter('router.failovers')
+        self.__fanout_failed = metrics.counter('router.fanout_failed')
+
+    def __repr__(self):
+        return '<CloudRouter {}>'.format(', '.join(
+            '{}->{}'.format(name, active) for name, active in self.__active.items()
+        ))
+
+    def add(self, name, cloud, backup=None):
+        if name in self.__endpoints:
+            raise ValueError('cloud endpoint \"{}\" already exists.'.format(name))
+        self.__endpoints[name] = Endpoint(name, cloud, backup=backup)
+        self.__active[name] = name
+
+    def get(self, name):
+        return self.__endpoints[name].cloud
+
+    @property
+    def endpoints(self):
+        return list(self.__endpoints.values())
+
+    def active(self, name):
+        """name of the endpoint currently serving `name`, its backup after a failover."""
+        return self.__active[name]
+
+    def backup(self, name):
+        return self.__endpoints[name].backup
+
+    def is_status_ok(self, name):
+        return self.__endpoints[self.__active[name]].is_status_ok()
+
+    def start(self):
+        for endpoint in self.__endpoints.values():
+            if endpoint.backup is not None:
+                if endpoint.backup not in self.__endpoints:
+                    raise ValueError('backup \"{}\" of \"{}\" not configured.'.format(endpoint.backup, endpoint.name))
+                if not self.__health_thread.is_running():
+                    self.__health_thread.start()
+
+    def stop(self):
+        self.__health_thread.stop()
+
+    def __switch(self, endpoint, to):
+        with self.__lock:
+            if self.__active[endpoint.name] == to:
+                return
+            self.__active[endpoint.name] = to
+            endpoint.failures = 0
+            endpoint.since = None
+        if to != endpoint.name:
+            self.__failovers.inc()
+            logger.warn('cloud \"{}\" failover to \"{}\".'.format(endpoint.name, to))
+        else:
+            logger.info('cloud \"{}\" failback.'.format(endpoint.name))
+
+    def __send_one(self, name, data, topic):
+        endpoint = self.__endpoints[name]
+        active = self.__endpoints[self.__active[name]]
+        rv = active.send(data, topic=topic)
+        if rv is not False:
+            if active is endpoint:
+                endpoint.failures = 0
+            return rv
+        if active is endpoint and endpoint.backup is not None:
+            endpoint.failures += 1
+            if endpoint.failures >= self.__max_failures and self.__endpoints[endpoint.backup].is_status_ok():
+                self.__switch(endpoint, endpoint.backup)
+                return self.__endpoints[endpoint.backup].send(data, topic=topic)
+        return False
+
+    def send(self, names, data, topic=None):
+        """send `data` to every endpoint in `names` without copying it, return the result of the first one."""
+        rv = self.__send_one(names[0], data, topic)
+        for i in range(1, len(names)):
+            try:
+                ok = self.__send_one(names[i], data, topic) is not False
+            except Exception as e:
+                logger.error('fan-out to \"{}\" error: {}'.format(names[i], e))
+                ok = False
+            if not ok:
+                self.__fanout_failed.inc()
+        return rv
+
+    def __check(self, endpoint):
+        now = utime.ticks_ms()
+        healthy = endpoint.is_status_ok()
+        failed_over = self.__active[endpoint.name] != endpoint.name
+        if healthy == failed_over:
+            # primary down while active, or back up while failed over: time how long it stays that way.
+            if endpoint.since is None:
+                endpoint.since = now
+            elapsed = utime.ticks_diff(now, endpoint.since)
+            if failed_over and elapsed >= self.__failback_after:
+                self.__switch(endpoint, endpoint.name)
+            elif not failed_over and elapsed >= self.__failover_after \
+                    and self.__endpoints[endpoint.backup].is_status_ok():
+                self.__switch(endpoint, endpoint.backup)
+        else:
+            endpoint.since = None
+
+    def __health_thread_worker(self):
+        while True:
+            utime.sleep(self.__health_interval)
+            for endpoint in self.__endpoints.values():
+                if endpoint.backup is None:
+                    continue
+                try:
+                    self.__check(endpoint)
+                except Exception as e:
+                    logger.error('cloud \"{}\" health check error: {}'.format(endpoint.name, e))
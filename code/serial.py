@@ -1,5 +1,8 @@
+import utime
 from machine import UART
 from usr.threading import Condition, Lock
+from usr.utils import RingBuffer
+from usr.metrics import Metrics
 
 
 class Serial(object):
@@ -7,7 +10,8 @@ class Serial(object):
     class TimeoutError(Exception):
         pass
 
-    def __init__(self, port=2, baudrate=115200, bytesize=8, parity=0, stopbits=1, flowctl=0, rs485_config=None):
+    def __init__(self, port=2, baudrate=115200, bytesize=8, parity=0, stopbits=1, flowctl=0, rs485_config=None,
+                 rx_buffer_size=2048):
         self.__port = port
         self.__baudrate = baudrate
         self.__bytesize = bytesize
@@ -16,6 +20,12 @@ class Serial(object):
         self.__flowctl = flowctl
         self.__rs485_config = rs485_config
         self.__uart = None
+        self.__rx = RingBuffer(rx_buffer_size)
+        self.__rx_stamp = None  # ticks of the uart callback that announced the oldest unread bytes
+        metrics = Metrics()
+        self.__rx_bytes = metrics.counter('serial{}.rx_bytes'.format(port))
+        self.__tx_bytes = metrics.counter('serial{}.tx_bytes'.format(port))
+        self.__timeouts = metrics.counter('serial{}.timeouts'.format(port))
         self.__r_cond = Condition()
         self.__w_cond = Lock()
 
@@ -26,6 +36,12 @@ class Serial(object):
             self.__rs485_config
         )
 
+    @property
+    def char_time_us(self):
+        """time on the wire of one character (start + data + parity + stop bits), in microseconds."""
+        bits = 1 + self.__bytesize + (1 if self.__parity else 0) + self.__stopbits
+        return bits * 1000000 // self.__baudrate
+
     @property
     def uart(self):
         if self.__uart is None:
@@ -47,6 +63,8 @@ class Serial(object):
             self.__uart.control_485(gpio_num, direction)
 
         self.__uart.set_callback(self.__uart_cb)
+        # registered once the port is open, a failed open leaves the gauge of the previous owner alone.
+        Metrics().gauge('serial{}.rx_buffered'.format(self.__port), lambda: len(self.__rx))
 
     def close(self):
         self.__uart.close()
@@ -54,15 +72,76 @@ class Serial(object):
 
     def __uart_cb(self, _):
         with self.__r_cond:
+            if self.__rx_stamp is None:
+                self.__rx_stamp = utime.ticks_ms()
             self.__r_cond.notify_all()
 
+    def take_rx_stamp(self):
+        """ticks_ms when the oldest just-consumed bytes were announced by the uart callback."""
+        with self.__r_cond:
+            now = utime.ticks_ms()
+            stamp = now if self.__rx_stamp is None else self.__rx_stamp
+            # bytes left over belong to the next frame, their exact arrival is unknown so count from now.
+            self.__rx_stamp = now if len(self.__rx) or self.uart.any() else None
+            return stamp
+
     def write(self, data):
         with self.__w_cond:
+            self.__tx_bytes.inc(len(data))
             return self.uart.write(data)
 
+    @property
+    def rx_buffer(self):
+        """receive ring buffer, filled by `fill`/`readinto`/`read`."""
+        return self.__rx
+
+    def __pull(self):
+        # move pending uart bytes into the receive ring buffer.
+        readinto = getattr(self.uart, 'readinto', None)
+        pending = self.uart.any()
+        while pending > 0 and self.__rx.free() > 0:
+            view = self.__rx.write_view()
+            n = min(len(view), pending)
+            if readinto is not None:
+                n = readinto(view[:n]) or 0
+                self.__rx.commit(n)
+            else:
+                # firmware without `UART.readinto`, fall back to read and copy.
+                n = self.__rx.write(self.uart.read(n))
+            if n == 0:
+                break
+            self.__rx_bytes.inc(n)
+            pending -= n
+        return len(self.__rx)
+
+    def __wait_data(self, timeout):
+        if not self.__r_cond.wait_for(lambda: len(self.__rx) != 0 or self.uart.any() != 0, timeout=timeout):
+            self.__timeouts.inc()
+            raise self.TimeoutError('serial read timeout.')
+
+    def fill(self, timeout=None):
+        """wait for new uart data and accumulate it in `rx_buffer`, return the number of buffered bytes.
+
+        unlike `read`, bytes already buffered do not satisfy the wait, so a timeout here means the line went idle.
+        """
+        with self.__r_cond:
+            if self.__rx.free() > 0:
+                if not self.__r_cond.wait_for(lambda: self.uart.any() != 0, timeout=timeout):
+                    raise self.TimeoutError('serial read timeout.')
+            return self.__pull()
+
+    def readinto(self, buf, timeout=None):
+        """read available bytes into the writable buffer `buf` without allocating, return the number of bytes read."""
+        with self.__r_cond:
+            self.__wait_data(timeout)
+            self.__pull()
+            return self.__rx.readinto(buf)
+
     def read(self, size, timeout=None):
+        """read up to `size` bytes, `timeout` in seconds (e.g. 0.05 for 50 ms), raise `TimeoutError` on expiry."""
         with self.__r_cond:
-            if self.__r_cond.wait_for(lambda: self.uart.any() != 0, timeout=timeout):
-                return self.uart.read(min(size, self.uart.any()))
-            else:
-                raise self.TimeoutError('serial read timeout.')
+            self.__wait_data(timeout)
+            self.__pull()
+            data = bytes(self.__rx.read_view(size))
+            self.__rx.consume(len(data))
+            return data
@@ -1,14 +1,91 @@
+import ql_fs
 import utime
+import ustruct
 import usocket
+import sys_bus
 from usr import network
+from usr.utils import Singleton, RingBuffer
 from usr.logging import getLogger
 from usr.threading import Queue, Thread, Condition, Lock
 from usr.cloud_abc import CloudABC
+from usr.reconnect import ReconnectManager
+from usr.metrics import Metrics
+from usr.codec import Envelope, StreamDecoder
 
 
 logger = getLogger(__name__)
 
 
+@Singleton
+class DnsCache(object):
+    """resolved server addresses with a TTL.
+
+    the address list of every host is persisted to flash, so a failed lookup falls back to the last known good
+    address, and `rotate` moves to the next A record after a connect failure.
+    """
+    PATH = '/usr/dns_cache.json'
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.__entries = {}  # 'host:port' -> {'addrs': [(family, ip, port), ...], 'index': int, 'stamp': ticks_ms}
+        self.__lock = Lock()
+        self.__persisted = {}
+        if ql_fs.path_exists(self.PATH):
+            try:
+                self.__persisted = ql_fs.read_json(self.PATH)
+            except Exception as e:
+                logger.error('load dns cache failed: {}'.format(e))
+
+    def __save(self, key, addrs):
+        self.__persisted[key] = [list(addr) for addr in addrs]
+        try:
+            ql_fs.touch(self.PATH, self.__persisted)
+        except Exception as e:
+            logger.error('save dns cache failed: {}'.format(e))
+
+    def resolve(self, host, port):
+        """return (family, ip, port) for host, from cache while fresh, from flash if the lookup fails."""
+        key = '{}:{}'.format(host, port)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and utime.ticks_diff(utime.ticks_ms(), entry['stamp']) < self.ttl * 1000:
+                return entry['addrs'][entry['index']]
+        try:
+            rv = usocket.getaddrinfo(host, port)
+            if not rv:
+                raise ValueError('DNS detect error for addr: {},{}.'.format(host, port))
+            addrs = [(item[0], item[4][0], item[4][1]) for item in rv]
+        except Exception as e:
+            if entry is None and key not in self.__persisted:
+                raise
+            logger.warn('resolve {} failed ({}), use last known address.'.format(key, e))
+            addrs = entry['addrs'] if entry is not None else [tuple(addr) for addr in self.__persisted[key]]
+        with self.__lock:
+            index = 0
+            if entry is not None and entry['addrs'] == addrs:
+                index = entry['index']
+            self.__entries[key] = {'addrs': addrs, 'index': index, 'stamp': utime.ticks_ms()}
+            if [list(addr) for addr in addrs] != self.__persisted.get(key):
+                self.__save(key, addrs)
+            return addrs[index]
+
+    def rotate(self, host, port):
+        """switch host to its next resolved address, e.g. after a connect failure."""
+        key = '{}:{}'.format(host, port)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and len(entry['addrs']) > 1:
+                entry['index'] = (entry['index'] + 1) % len(entry['addrs'])
+                logger.info('{} rotate to {}.'.format(key, entry['addrs'][entry['index']][1]))
+
+    def invalidate(self, host=None, port=None):
+        with self.__lock:
+            if host is None:
+                self.__entries.clear()
+            else:
+                self.__entries.pop('{}:{}'.format(host, port), None)
+
+
 class Socket(object):
 
     def __init__(self, host, port, timeout=5, keep_alive=None, protocol='TCP'):
@@ -16,7 +93,6 @@ class Socket(object):
         self.__port = port
         self.__ip = None
         self.__family = None
-        self.__domain = None
         self.__timeout = timeout
         self.__keep_alive = keep_alive
         self.__sock = None
@@ -34,23 +110,23 @@ class Socket(object):
             self.__port
         )
 
-    def __init_args(self):
-        rv = usocket.getaddrinfo(self.__host, self.__port)
-        if not rv:
-            raise ValueError('DNS detect error for addr: {},{}.'.format(self.__host, self.__port))
-        self.__family = rv[0][0]
-        self.__domain = rv[0][3]
-        self.__ip, self.__port = rv[0][4]
+    def resolve(self):
+        self.__family, self.__ip, self.__port = DnsCache().resolve(self.__host, self.__port)
+        return True
 
     def connect(self):
-        self.__init_args()
+        self.resolve()
         self.__sock = usocket.socket(self.__family, self.__sock_type)
         if self.__sock_type == usocket.SOCK_STREAM:
-            self.__sock.connect((self.__ip, self.__port))
-            if self.__timeout and self.__timeout > 0:
-                self.__sock.settimeout(self.__timeout)
+            try:
+                self.__sock.connect((self.__ip, self.__port))
+            except Exception:
+                DnsCache().rotate(self.__host, self.__port)
+                raise
             if self.__keep_alive and self.__keep_alive > 0:
                 self.__sock.setsockopt(usocket.SOL_SOCKET, usocket.TCP_KEEPALIVE, self.__keep_alive)
+        if self.__timeout and self.__timeout > 0:
+            self.__sock.settimeout(self.__timeout)
 
     def disconnect(self):
         if self.__sock:
@@ -75,6 +151,411 @@ class Socket(object):
     def read(self, size=1024):
         return self.__sock.recv(size)
 
+    def readinto(self, buf):
+        return self.__sock.readinto(buf)
+
+    def recvfrom(self, size=1024):
+        """udp datagram from the server, None for datagrams from any other source."""
+        data, addr = self.__sock.recvfrom(size)
+        if addr[0] != self.__ip or addr[1] != self.__port:
+            logger.debug('drop datagram from {}.'.format(addr))
+            return None
+        return data
+
+
+class Coalescer(object):
+    """Nagle-like uplink batching, bytes are accumulated for up to `window_ms` or `max_bytes` then sent at once.
+
+    two preallocated buffers are swapped on flush, so writers keep filling one while the other is on the wire.
+    with `split` False a write is never divided between two batches, it waits for the next batch when it does not
+    fit (udp datagrams must hold whole records).
+    a batch whose flush fails is kept and flushed again every `retry_interval` seconds before any newer batch, `write`
+    refuses new data meanwhile, so accepted bytes are neither lost nor overtaken by data the caller spools instead.
+    """
+
+    def __init__(self, flush, window_ms=20, max_bytes=1024, split=True, retry_interval=1):
+        if window_ms <= 0 or max_bytes <= 0:
+            raise ValueError('coalesce window and size must be greater than 0.')
+        self.__flush = flush
+        self.__window = window_ms / 1000
+        self.__size = max_bytes
+        self.__split = split
+        self.__active = memoryview(bytearray(max_bytes))
+        self.__standby = memoryview(bytearray(max_bytes))
+        self.__fill = 0
+        self.__need = 0  # size of a whole write waiting for room, flushes the batch early
+        self.__failed = None  # batch whose flush failed, flushed again before anything else
+        self.__retry_interval = retry_interval
+        self.__cond = Condition()
+        self.__flush_thread = Thread(target=self.__flush_thread_worker)
+
+    def start(self):
+        self.__flush_thread.start()
+
+    def stop(self):
+        self.__flush_thread.stop()
+
+    def __full(self):
+        return self.__fill >= self.__size or self.__fill + self.__need > self.__size
+
+    def write(self, data):
+        """add `data` to the batch, False while a failed batch is pending."""
+        length = len(data)
+        offset = 0
+        with self.__cond:
+            if self.__failed is not None:
+                return False
+            if not self.__split:
+                if length > self.__size:
+                    raise ValueError('{} bytes do not fit a batch of {} bytes.'.format(length, self.__size))
+                self.__need = length
+                self.__cond.notify_all()
+                self.__cond.wait_for(lambda: self.__fill + length <= self.__size)
+                self.__need = 0
+            while offset < length:
+                self.__cond.wait_for(lambda: self.__fill < self.__size)
+                n = min(self.__size - self.__fill, length - offset)
+                self.__active[self.__fill:self.__fill + n] = data[offset:offset + n]
+                self.__fill += n
+                offset += n
+                self.__cond.notify_all()
+        return True
+
+    def __flush_thread_worker(self):
+        while True:
+            view = self.__failed
+            if view is None:
+                with self.__cond:
+                    self.__cond.wait_for(lambda: self.__fill > 0)
+                    if not self.__full():
+                        self.__cond.wait_for(self.__full, timeout=self.__window)
+                    view = self.__active[:self.__fill]
+                    # the standby buffer is only reused once `view` went out.
+                    self.__active, self.__standby = self.__standby, self.__active
+                    self.__fill = 0
+                    self.__cond.notify_all()
+            try:
+                ok = self.__flush(view)
+            except Exception as e:
+                logger.error('coalesced send error: {}'.format(e))
+                ok = False
+            with self.__cond:
+                if ok:
+                    if self.__failed is not None:
+                        logger.info('coalesced batch of {} bytes resent.'.format(len(view)))
+                    self.__failed = None
+                    continue
+                if self.__failed is None:
+                    logger.error('coalesced send of {} bytes failed, keep it for retry.'.format(len(view)))
+                self.__failed = view
+            utime.sleep(self.__retry_interval)
+
+
+class FrameDecoder(object):
+    """incremental decoder for `FramedLink` frames.
+
+    socket data is read straight into a ring buffer (`write_view` + `commit`), `next` hands out complete frames as
+    memoryviews into the ring (or into one scratch buffer when a frame wraps around its end). a frame stays valid until
+    the following `next` call.
+    """
+
+    def __init__(self, max_payload=1024):
+        self.__max_payload = max_payload
+        self.__ring = RingBuffer(2 * (FramedLink.HEADER_SIZE + max_payload))
+        self.__scratch = memoryview(bytearray(max_payload))
+        self.__header = bytearray(FramedLink.HEADER_SIZE)
+        self.__pending = 0  # payload bytes of the last frame handed out, released on the next call
+
+    def write_view(self):
+        return self.__ring.write_view()
+
+    def commit(self, n):
+        self.__ring.commit(n)
+
+    def reset(self):
+        self.__ring.clear()
+        self.__pending = 0
+
+    def next(self):
+        """(type, seq, payload) of the next complete frame, None if more data is needed."""
+        ring = self.__ring
+        if self.__pending:
+            ring.consume(self.__pending)
+            self.__pending = 0
+        if len(ring) < FramedLink.HEADER_SIZE:
+            return None
+        length = (ring.peek(0) << 8) | ring.peek(1)
+        if length > self.__max_payload:
+            raise ValueError('frame of {} bytes exceeds max_payload {}.'.format(length, self.__max_payload))
+        if len(ring) < FramedLink.HEADER_SIZE + length:
+            return None
+        ring.readinto(self.__header)
+        _, frame_type, seq = ustruct.unpack(FramedLink.HEADER, self.__header)
+        payload = ring.read_view(length)
+        if len(payload) < length:
+            payload = self.__scratch[:length]
+            ring.readinto(payload)
+        else:
+            self.__pending = length
+        return frame_type, seq, payload
+
+
+class FramedLink(object):
+    """reliable message framing over tcp.
+
+    every frame is `<length:2><type:1><seq:2><payload>` (big-endian, `length` counts the payload). DATA frames carry a
+    16 bit sequence number per direction and are acknowledged by cumulative ACK frames (ACK n acknowledges every frame
+    up to n). up to `window` DATA frames may be unacknowledged, after `ack_timeout` seconds without progress they are
+    all sent again (go-back-N) and they are also resent after a reconnect, the peer drops duplicates by sequence
+    number. PING frames are sent after `heartbeat` seconds without traffic and answered with PONG, a link that stays
+    silent for three heartbeats is considered dead.
+    """
+    HEADER = '!HBH'
+    HEADER_SIZE = ustruct.calcsize(HEADER)
+    DATA = 0x01
+    ACK = 0x02
+    PING = 0x03
+    PONG = 0x04
+
+    def __init__(self, write, window=8, ack_timeout=10, heartbeat=30, max_payload=1024, name='tcp'):
+        """write - callable sending one frame on the socket. name - prefix of the metric names."""
+        if window <= 0 or window >= 0x8000:
+            raise ValueError('framed window must be within 1 ~ 32767.')
+        self.__write = write
+        self.__window = window
+        self.__ack_timeout = ack_timeout
+        self.__heartbeat = heartbeat * 1000
+        self.__max_payload = max_payload
+        self.__tx_seq = 0
+        self.__unacked = []  # [[seq, frame, sent ticks]], oldest first
+        self.__rx_seq = None  # next expected downlink seq, synced to the first DATA of a connection
+        self.__last_rx = self.__last_tx = utime.ticks_ms()
+        self.__cond = Condition()
+        self.__write_lock = Lock()
+        self.decoder = FrameDecoder(max_payload)
+        metrics = Metrics()
+        self.__retransmits = metrics.counter('{}.retransmits'.format(name))
+        metrics.gauge('{}.unacked'.format(name), lambda: len(self.__unacked))
+
+    @property
+    def max_payload(self):
+        return self.__max_payload
+
+    def __frame(self, frame_type, seq, payload=b''):
+        frame = bytearray(self.HEADER_SIZE + len(payload))
+        ustruct.pack_into(self.HEADER, frame, 0, len(payload), frame_type, seq)
+        frame[self.HEADER_SIZE:] = payload
+        return frame
+
+    def __send_frame(self, frame):
+        with self.__write_lock:
+            self.__last_tx = utime.ticks_ms()
+            return self.__write(frame)
+
+    def send(self, payload):
+        """queue `payload` as a DATA frame and send it, False if the window stays full for `ack_timeout`.
+
+        a frame taken into the window is delivered by retransmission even if this write fails.
+        """
+        if len(payload) > self.__max_payload:
+            raise ValueError('payload of {} bytes exceeds max_payload {}.'.format(len(payload), self.__max_payload))
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: len(self.__unacked) < self.__window, timeout=self.__ack_timeout):
+                return False
+            seq = self.__tx_seq
+            self.__tx_seq = (seq + 1) & 0xFFFF
+            frame = self.__frame(self.DATA, seq, payload)
+            self.__unacked.append([seq, frame, utime.ticks_ms()])
+        self.__send_frame(frame)
+        return True
+
+    def __ack(self, seq):
+        with self.__cond:
+            # pop every frame up to and including `seq`, in 16 bit serial number arithmetic.
+            while self.__unacked and ((seq - self.__unacked[0][0]) & 0xFFFF) < 0x8000:
+                self.__unacked.pop(0)
+            self.__cond.notify_all()
+
+    def receive(self):
+        """parse buffered frames, handle control frames and return the payloads of new DATA frames (copied)."""
+        rv = []
+        ack = False
+        while True:
+            frame = self.decoder.next()
+            if frame is None:
+                break
+            frame_type, seq, payload = frame
+            self.__last_rx = utime.ticks_ms()
+            if frame_type == self.DATA:
+                ack = True
+                if self.__rx_seq is None or seq == self.__rx_seq:
+                    self.__rx_seq = (seq + 1) & 0xFFFF
+                    rv.append(bytes(payload))
+                # duplicates and frames after a gap are dropped, the cumulative ACK makes the peer resend.
+            elif frame_type == self.ACK:
+                self.__ack(seq)
+            elif frame_type == self.PING:
+                self.__send_frame(self.__frame(self.PONG, seq))
+        if ack:
+            # one cumulative ACK for everything read in this chunk.
+            self.__send_frame(self.__frame(self.ACK, (self.__rx_seq - 1) & 0xFFFF))
+        return rv
+
+    def resend(self):
+        with self.__cond:
+            pending = list(self.__unacked)
+            now = utime.ticks_ms()
+            for item in pending:
+                item[2] = now
+        for _, frame, _ in pending:
+            self.__send_frame(frame)
+            self.__retransmits.inc()
+        return len(pending)
+
+    def reset(self):
+        """start a new connection: drop partial input, resync the downlink seq and resend unacked frames."""
+        self.decoder.reset()
+        self.__rx_seq = None
+        self.__last_rx = self.__last_tx = utime.ticks_ms()
+        if self.resend():
+            logger.info('framed link resent {} unacked frames.'.format(len(self.__unacked)))
+
+    def tick(self):
+        """heartbeat and retransmission timer, call it regularly. returns False once the link is considered dead."""
+        now = utime.ticks_ms()
+        if self.__unacked and utime.ticks_diff(now, self.__unacked[0][2]) >= self.__ack_timeout * 1000:
+            logger.warn('framed link ack timeout, resend {} frames.'.format(self.resend()))
+        if self.__heartbeat <= 0:
+            return True
+        if utime.ticks_diff(now, self.__last_tx) >= self.__heartbeat:
+            self.__send_frame(self.__frame(self.PING, 0))
+        return utime.ticks_diff(now, self.__last_rx) < 3 * self.__heartbeat
+
+
+class DatagramLink(object):
+    """batched udp datagrams with optional acknowledgement.
+
+    a datagram is `<type:1><seq:2>` (big-endian) and for DATA a body of `<length:2><payload>` records, so one
+    datagram carries several serial frames. with `ack` every DATA datagram must be answered by an ACK datagram with
+    its seq within `ack_timeout` seconds, else it is sent again up to `retries` times (stop-and-wait, one datagram in
+    flight). the receiver acknowledges every DATA datagram and drops a repeat of the last seq. a datagram that is
+    never acknowledged marks the link dead until `reset`.
+    """
+    HEADER = '!BH'
+    HEADER_SIZE = ustruct.calcsize(HEADER)
+    RECORD = '!H'
+    RECORD_SIZE = ustruct.calcsize(RECORD)
+    DATA = 0x01
+    ACK = 0x02
+
+    def __init__(self, write, mtu=1200, ack=False, ack_timeout=2, retries=3, name='udp'):
+        """write - callable sending one datagram. mtu - largest datagram sent, headers included. name - prefix of the
+        metric names.
+        """
+        if mtu <= self.HEADER_SIZE + self.RECORD_SIZE:
+            raise ValueError('udp mtu too small.')
+        self.__write = write
+        self.__mtu = mtu
+        self.__ack = ack
+        self.__ack_timeout = ack_timeout
+        self.__retries = retries
+        self.__datagram = memoryview(bytearray(mtu))  # guarded by the send lock
+        self.__tx_seq = 0
+        self.__acked = None  # seq of the last ACK received
+        self.__rx_seq = None  # seq of the last DATA received
+        self.__cond = Condition()
+        self.__send_lock = Lock()
+        self.alive = True
+        metrics = Metrics()
+        self.__retransmits = metrics.counter('{}.retransmits'.format(name))
+        self.__lost = metrics.counter('{}.lost'.format(name))
+
+    @property
+    def mtu(self):
+        return self.__mtu
+
+    @property
+    def capacity(self):
+        """body bytes available in one datagram."""
+        return self.__mtu - self.HEADER_SIZE
+
+    @classmethod
+    def record(cls, payload):
+        out = bytearray(cls.RECORD_SIZE + len(payload))
+        ustruct.pack_into(cls.RECORD, out, 0, len(payload))
+        out[cls.RECORD_SIZE:] = payload
+        return out
+
+    @classmethod
+    def records(cls, body):
+        """payloads (copied) of the records in a DATA body."""
+        rv = []
+        view = memoryview(body)
+        offset = 0
+        while offset < len(view):
+            if offset + cls.RECORD_SIZE > len(view):
+                raise ValueError('truncated record header.')
+            length = ustruct.unpack_from(cls.RECORD, view, offset)[0]
+            offset += cls.RECORD_SIZE
+            if offset + length > len(view):
+                raise ValueError('truncated record of {} bytes.'.format(length))
+            rv.append(bytes(view[offset:offset + length]))
+            offset += length
+        return rv
+
+    def send(self, body):
+        """send `body` as one DATA datagram, with `ack` False unless it was acknowledged."""
+        if len(body) > self.capacity:
+            raise ValueError('datagram body of {} bytes exceeds mtu {}.'.format(len(body), self.__mtu))
+        with self.__send_lock:
+            seq = self.__tx_seq
+            self.__tx_seq = (seq + 1) & 0xFFFF
+            size = self.HEADER_SIZE + len(body)
+            ustruct.pack_into(self.HEADER, self.__datagram, 0, self.DATA, seq)
+            self.__datagram[self.HEADER_SIZE:size] = body
+            datagram = self.__datagram[:size]
+            if not self.__ack:
+                return self.__write(datagram)
+            for attempt in range(self.__retries + 1):
+                if attempt:
+                    self.__retransmits.inc()
+                if not self.__write(datagram):
+                    return False
+                with self.__cond:
+                    if self.__cond.wait_for(lambda: self.__acked == seq, timeout=self.__ack_timeout):
+                        self.alive = True
+                        return True
+            self.__lost.inc()
+            self.alive = False
+            logger.warn('udp datagram {} not acknowledged after {} retries.'.format(seq, self.__retries))
+            return False
+
+    def receive(self, datagram):
+        """handle one datagram from the server, the body of a new DATA datagram or None."""
+        if len(datagram) < self.HEADER_SIZE:
+            return None
+        datagram_type, seq = ustruct.unpack_from(self.HEADER, datagram, 0)
+        if datagram_type == self.ACK:
+            with self.__cond:
+                self.__acked = seq
+                self.__cond.notify_all()
+            return None
+        if datagram_type != self.DATA:
+            return None
+        if self.__ack:
+            # acknowledge repeats too, the previous ACK may be the one that got lost.
+            ack = bytearray(self.HEADER_SIZE)
+            ustruct.pack_into(self.HEADER, ack, 0, self.ACK, seq)
+            self.__write(ack)
+        if seq == self.__rx_seq:
+            return None
+        self.__rx_seq = seq
+        return memoryview(datagram)[self.HEADER_SIZE:]
+
+    def reset(self):
+        self.__rx_seq = None
+        self.alive = True
+
 
 class SocketIot(CloudABC):
 
@@ -83,44 +564,178 @@ class SocketIot(CloudABC):
             domain=None,
             port=None,
             timeout=None,
-            keep_alive=None
+            keep_alive=None,
+            coalesce_ms=0,
+            coalesce_bytes=1024,
+            reconnect=None,
+            codec=None,
+            framed=None,
+            protocol='TCP',
+            udp=None,
+            name=None
     ):
-        self.__sock = Socket(domain, port, timeout=timeout, keep_alive=keep_alive)
+        """
+        coalesce_ms - (optional) batch uplink bytes for up to this many milliseconds before sending, 0 disables it.
+        coalesce_bytes - (optional) flush the batch as soon as it holds this many bytes.
+        reconnect - (optional) backoff settings for `ReconnectManager`, e.g. {"base_delay": 1, "max_delay": 300}.
+        codec - (optional) compress every write (a whole coalesced batch when coalescing) into a length-prefixed
+            envelope, codec name or {"name": "lzf", "dictionary": ...}, see `usr.codec`. downlink must use envelopes
+            too.
+        framed - (optional) exchange `FramedLink` frames instead of a raw byte stream, dict of its settings
+            (window, ack_timeout, heartbeat, max_payload), an empty dict uses the defaults. `timeout` should stay well
+            below `heartbeat` since the heartbeat is checked between socket reads.
+        protocol - "TCP" or "UDP". udp sends `DatagramLink` datagrams, with `coalesce_ms` several messages are packed
+            into one datagram up to the mtu (`coalesce_bytes` is not used).
+        udp - (optional) dict of `DatagramLink` settings (mtu, ack, ack_timeout, retries) and `max_message`, the
+            largest message `send` takes (default 1024, the DTU's largest serial frame), it must fit one datagram.
+        name - (optional) connection name, metrics are then named `tcp.<name>.*` (`udp.<name>.*`) instead of `tcp.*`.
+        """
+        if protocol not in ('TCP', 'UDP'):
+            raise ValueError('protocol \"{}\" not supported, choose from TCP, UDP.'.format(protocol))
+        if protocol == 'UDP' and framed is not None:
+            raise ValueError('framed mode needs TCP.')
+        self.__name = protocol.lower() if name is None else '{}.{}'.format(protocol.lower(), name)
+        codec_name = 'codec' if name is None else 'codec.{}'.format(name)
+        self.__sock = Socket(domain, port, timeout=timeout, keep_alive=keep_alive, protocol=protocol)
+        self.__coalescer = None
+        self.__envelope = None
+        self.__decoder = None
+        self.__link = None
+        self.__net_up = True
+        self.__max_record = None
+        if protocol == 'UDP':
+            udp = dict(udp or {})
+            max_message = udp.pop('max_message', 1024)
+            self.__link = DatagramLink(self.__write_frame, name=self.__name, **udp)
+            # a record is never split across datagrams, the envelope may add its codec byte.
+            self.__max_record = self.__link.capacity - (codec is not None)
+            if DatagramLink.RECORD_SIZE + max_message > self.__max_record:
+                raise ValueError('udp max_message {} does not fit the mtu {}.'.format(max_message, self.__link.mtu))
+            if coalesce_ms and coalesce_ms > 0:
+                # the whole batch may grow by one byte when it is wrapped in an envelope.
+                self.__coalescer = Coalescer(
+                    self.__write, window_ms=coalesce_ms, max_bytes=self.__max_record, split=False
+                )
+            if codec is not None:
+                self.__envelope = Envelope(codec, name=codec_name)
+        elif coalesce_ms and coalesce_ms > 0:
+            self.__coalescer = Coalescer(self.__write, window_ms=coalesce_ms, max_bytes=coalesce_bytes)
+        if framed is not None:
+            self.__link = FramedLink(self.__write_frame, name=self.__name, **framed)
+            if self.__coalescer is not None and coalesce_bytes + (codec is not None) > self.__link.max_payload:
+                raise ValueError('coalesce_bytes does not fit the framed max_payload.')
+        if codec is not None and protocol == 'TCP':
+            # frames delimit messages themselves, only the raw stream needs length-prefixed envelopes.
+            self.__envelope = Envelope(codec, stream=self.__link is None, name=codec_name)
+            if self.__link is None:
+                self.__decoder = StreamDecoder(self.__envelope)
         self.__queue = Queue()
         self.__listen_thread = Thread(target=self.__listen_thread_worker)
-        self.__reconn_thread = Thread(target=self.__reconnect)
-        self.__reconn_cond = Condition()
-        self.__reconn_mutex = Lock()
+        self.__reconn = ReconnectManager(
+            self.__name, self.connect, disconnect=self.__disconnect, resolve=self.__resolve, **(reconnect or {})
+        )
+        if protocol == 'UDP':
+            sys_bus.subscribe(network.NET_STATUS_TOPIC, self.__on_net_status)
+        metrics = Metrics()
+        self.__sent_bytes = metrics.counter('{}.sent_bytes'.format(self.__name))
+        self.__send_failed = metrics.counter('{}.send_failed'.format(self.__name))
+        self.__received_bytes = metrics.counter('{}.received_bytes'.format(self.__name))
+        metrics.gauge('{}.reconnects'.format(self.__name), lambda: self.__reconn.stats()['reconnects'])
+        metrics.gauge('{}.recv_queue'.format(self.__name), self.__queue.size)
+
+    def __on_net_status(self, topic, args):
+        # dataCall callback args: (profile_id, state, ...), the local address may change once the data call is back.
+        # only a socket opened before the outage is stale, `ReconnectManager` already handles a reconnect in backoff.
+        was_up = self.__net_up
+        self.__net_up = args[1] == 1
+        if self.__net_up and not was_up and self.__reconn.state == ReconnectManager.CONNECTED:
+            self.reconnect()
+
+    def __receive(self):
+        data = self.__sock.read(1024)
+        self.__received_bytes.inc(len(data))
+        if self.__decoder is None:
+            self.__queue.put({'data': data, 'stamp': utime.ticks_ms()})
+            return
+        stamp = utime.ticks_ms()
+        for payload in self.__decoder.feed(data):
+            self.__queue.put({'data': payload, 'stamp': stamp})
+
+    def __receive_framed(self):
+        # read straight into the frame decoder's ring buffer.
+        link = self.__link
+        try:
+            n = self.__sock.readinto(link.decoder.write_view())
+            if not n:
+                raise OSError(-1, 'connection closed by peer')
+            self.__received_bytes.inc(n)
+            link.decoder.commit(n)
+            stamp = utime.ticks_ms()
+            for payload in link.receive():
+                if self.__envelope is not None:
+                    try:
+                        payload = bytes(self.__envelope.decode(payload))
+                    except Exception as e:
+                        # frame boundaries are intact, only this message is lost.
+                        logger.error('tcp envelope decode error, message dropped: {}'.format(e))
+                        continue
+                self.__queue.put({'data': payload, 'stamp': stamp})
+        except OSError as e:
+            if e.args[0] != 110:
+                raise
+        if not link.tick():
+            raise ValueError('framed link heartbeat timeout')
+
+    def __receive_datagram(self):
+        datagram = self.__sock.recvfrom(self.__link.mtu)
+        if datagram is None:
+            return
+        self.__received_bytes.inc(len(datagram))
+        stamp = utime.ticks_ms()
+        try:
+            body = self.__link.receive(datagram)
+            if body is None:
+                return
+            if self.__envelope is not None:
+                body = self.__envelope.decode(body)
+            payloads = DatagramLink.records(body)
+        except Exception as e:
+            # datagrams are independent, a bad one is dropped without reconnecting.
+            logger.error('udp datagram dropped: {}'.format(e))
+            return
+        for payload in payloads:
+            self.__queue.put({'data': payload, 'stamp': stamp})
 
     def __listen_thread_worker(self):
         while True:
             try:
-                data = self.__sock.read(1024)
-                self.__queue.put({'data': data})
+                if self.__link is None:
+                    self.__receive()
+                elif isinstance(self.__link, DatagramLink):
+                    self.__receive_datagram()
+                else:
+                    self.__receive_framed()
             except Exception as e:
                 if isinstance(e, OSError) and e.args[0] == 110:
                     # logger.debug('read timeout.')
                     continue
-                logger.error('tcp recv error: {}'.format(e))
-                with self.__reconn_cond:
-                    self.reconnect()
-                    self.__reconn_cond.wait_for(self.is_status_ok)
+                logger.error('{} recv error: {}'.format(self.__name, e))
+                self.reconnect()
+                self.__reconn.wait_connected()
 
     def reconnect(self):
-        with self.__reconn_mutex:
-            self.__reconn_thread.start()
+        self.__reconn.trigger()
 
-    def __reconnect(self):
-        while True:
-            network.wait_network_ready()
-            logger.info('connecting...')
-            with self.__reconn_cond:
-                self.__disconnect()
-                if self.connect():
-                    self.__reconn_cond.notify_all()
-                    logger.info('connect successfully.')
-                    break
-                utime.sleep(10)
+    @property
+    def reconnect_stats(self):
+        return self.__reconn.stats()
+
+    def __resolve(self):
+        try:
+            return self.__sock.resolve()
+        except Exception as e:
+            logger.error('socket resolve failed: {}'.format(e))
+            return False
 
     def __disconnect(self):
         try:
@@ -131,28 +746,89 @@ class SocketIot(CloudABC):
         return True
 
     def connect(self):
+        if self.__decoder is not None:
+            # a partial envelope from the old connection will never be completed.
+            self.__decoder = StreamDecoder(self.__envelope)
         try:
             self.__sock.connect()
         except Exception as e:
             logger.error('socket connect failed: {}'.format(e))
             return False
+        if self.__link is not None:
+            self.__link.reset()
         return True
 
     def listen(self):
         self.__listen_thread.start()
+        if self.__coalescer is not None:
+            self.__coalescer.start()
 
     def close(self):
         self.__listen_thread.stop()
-        self.__reconn_thread.stop()
+        self.__reconn.stop()
+        if self.__coalescer is not None:
+            self.__coalescer.stop()
         self.__disconnect()
 
+    @property
+    def threads(self):
+        # listen thread, reconnect thread and the coalescer's flush thread
+        return 2 + (self.__coalescer is not None)
+
     def is_status_ok(self):
+        if isinstance(self.__link, DatagramLink):
+            # udp has no connection state, use the data call and (with acks) whether the server still answers.
+            return self.__net_up and self.__link.alive and self.__sock.is_status_ok()
         return self.__sock.is_status_ok()
 
+    def __write_frame(self, frame):
+        try:
+            if self.__sock.write(frame):
+                return True
+        except Exception as e:
+            logger.error('{} write error: {}'.format(self.__name, e))
+        self.reconnect()
+        return False
+
+    def __write(self, data):
+        if self.is_status_ok():
+            if self.__envelope is not None:
+                data = self.__envelope.encode(data)
+            if self.__link is not None:
+                if self.__link.send(data):
+                    self.__sent_bytes.inc(len(data))
+                    return True
+                self.__send_failed.inc()
+                return False
+            if self.__sock.write(data):
+                self.__sent_bytes.inc(len(data))
+                return True
+            self.__send_failed.inc()
+            return False
+        else:
+            self.__send_failed.inc()
+            self.reconnect()
+            return False
+
     def send(self, data):
+        if isinstance(self.__link, DatagramLink):
+            data = DatagramLink.record(data)
+            if len(data) > self.__max_record:
+                logger.error('{} message of {} bytes exceeds udp max_message, rejected.'.format(
+                    self.__name, len(data) - DatagramLink.RECORD_SIZE
+                ))
+                self.__send_failed.inc()
+                return False
+        if self.__coalescer is None:
+            return self.__write(data)
         if self.is_status_ok():
-            return self.__sock.write(data)
+            if self.__coalescer.write(data):
+                return True
+            # the previous batch still waits to go out, the caller keeps `data` (e.g. spools it) to stay in order.
+            self.__send_failed.inc()
+            return False
         else:
+            self.__send_failed.inc()
             self.reconnect()
             return False
 
@@ -0,0 +1,198 @@
+import uos
+import ql_fs
+import ustruct
+from usr.utils import crc32
+from usr.threading import Lock
+from usr.logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class Spool(object):
+    """bounded, append-only store-and-forward spool on flash.
+
+    records are appended to numbered segment files as `<length:2><crc32:4><payload>`. when the total size exceeds
+    `max_size` the oldest segment is evicted. records are drained oldest first with `read_batch` and released with
+    `commit`, the read cursor is persisted so a reboot does not resend committed records.
+    """
+    HEADER = '<HI'
+    HEADER_SIZE = ustruct.calcsize(HEADER)
+    SEGMENT_SUFFIX = '.seg'
+
+    def __init__(self, path='/usr/spool', segment_size=16384, max_size=131072, read_size=4096):
+        if segment_size <= 0 or max_size < segment_size:
+            raise ValueError('invalid spool size, need 0 < segment_size <= max_size.')
+        self.__path = path
+        self.__segment_size = segment_size
+        self.__max_size = max_size
+        self.__read_size = read_size
+        self.__cursor_path = '{}/cursor.json'.format(path)
+        self.__lock = Lock()
+        self.__segments = []  # [[seq, size], ...], oldest first
+        self.__writer = None
+        self.__read_offset = 0
+        self.__batch = []  # record sizes (with header) returned by the last `read_batch`
+        self.__evicted = 0
+        self.__load()
+
+    def __repr__(self):
+        return '<Spool \"{}\" {} segments, {} bytes>'.format(self.__path, len(self.__segments), self.size())
+
+    def __segment_path(self, seq):
+        return '{}/{:08d}{}'.format(self.__path, seq, self.SEGMENT_SUFFIX)
+
+    def __load(self):
+        if not ql_fs.path_exists(self.__path):
+            ql_fs.mkdirs(self.__path)
+        for name in uos.listdir(self.__path):
+            if name.endswith(self.SEGMENT_SUFFIX):
+                seq = int(name[:-len(self.SEGMENT_SUFFIX)])
+                self.__segments.append([seq, uos.stat(self.__segment_path(seq))[6]])
+        self.__segments.sort(key=lambda item: item[0])
+        if self.__segments and ql_fs.path_exists(self.__cursor_path):
+            cursor = ql_fs.read_json(self.__cursor_path)
+            if cursor.get('seq') == self.__segments[0][0]:
+                self.__read_offset = min(cursor.get('offset', 0), self.__segments[0][1])
+        if self.__segments:
+            logger.info('spool loaded: {}'.format(self))
+
+    def __save_cursor(self):
+        seq = self.__segments[0][0] if self.__segments else 0
+        ql_fs.touch(self.__cursor_path, {'seq': seq, 'offset': self.__read_offset})
+
+    def __close_writer(self):
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+
+    def __remove_oldest(self):
+        seq, _ = self.__segments.pop(0)
+        if not self.__segments:
+            self.__close_writer()
+        uos.remove(self.__segment_path(seq))
+        self.__read_offset = 0
+        self.__batch = []
+
+    def __open_writer(self, size):
+        # segments left over from a previous boot are never appended to, their tail may be truncated.
+        if self.__writer is not None and self.__segments[-1][1] + size <= self.__segment_size:
+            return
+        self.__close_writer()
+        seq = self.__segments[-1][0] + 1 if self.__segments else 0
+        self.__segments.append([seq, 0])
+        self.__writer = open(self.__segment_path(seq), 'wb')
+
+    def __evict(self):
+        while len(self.__segments) > 1 and self.size() > self.__max_size:
+            logger.warn('spool full, evict segment {}.'.format(self.__segments[0][0]))
+            self.__remove_oldest()
+            self.__evicted += 1
+            self.__save_cursor()
+
+    def size(self):
+        return sum(item[1] for item in self.__segments)
+
+    def empty(self):
+        with self.__lock:
+            return not self.__segments or (len(self.__segments) == 1 and self.__read_offset >= self.__segments[0][1])
+
+    @property
+    def evicted(self):
+        """number of segments dropped because the spool was full."""
+        return self.__evicted
+
+    def append(self, data):
+        return self.append_many((data,))
+
+    def append_many(self, records):
+        """append records with a single open/flush, return the number of records written."""
+        total = 0
+        with self.__lock:
+            for data in records:
+                size = self.HEADER_SIZE + len(data)
+                if len(data) > 0xFFFF or size > self.__segment_size:
+                    logger.error('spool record of {} bytes too large, dropped.'.format(len(data)))
+                    continue
+                self.__open_writer(size)
+                self.__writer.write(ustruct.pack(self.HEADER, len(data), crc32(data)))
+                self.__writer.write(data)
+                self.__segments[-1][1] += size
+                total += 1
+            if self.__writer is not None:
+                self.__writer.flush()
+            self.__evict()
+        return total
+
+    def read_batch(self, max_records=32):
+        """read up to `max_records` records from the oldest segment with one file read.
+
+        the records stay in the spool until `commit` is called, calling `read_batch` again rereads them.
+        """
+        with self.__lock:
+            self.__batch = []
+            if not self.__segments:
+                return []
+            seq, seg_size = self.__segments[0]
+            if self.__read_offset >= seg_size:
+                return []
+            with open(self.__segment_path(seq), 'rb') as f:
+                f.seek(self.__read_offset)
+                chunk = f.read(min(self.__read_size, seg_size - self.__read_offset))
+            view = memoryview(chunk)
+            records = []
+            offset = 0
+            skipped = 0  # bytes of corrupt records not yet accounted to a returned record
+            while len(records) < max_records and offset + self.HEADER_SIZE <= len(chunk):
+                length, crc = ustruct.unpack_from(self.HEADER, chunk, offset)
+                end = offset + self.HEADER_SIZE + length
+                if end > len(chunk):
+                    if self.__read_offset + end > seg_size:
+                        # truncated record at the end of the segment (power loss while writing).
+                        logger.error('spool segment {} truncated, skip the rest of it.'.format(seq))
+                        skipped += seg_size - self.__read_offset - offset
+                    elif offset == 0:
+                        # single record larger than `read_size`, read it on its own.
+                        with open(self.__segment_path(seq), 'rb') as f:
+                            f.seek(self.__read_offset)
+                            chunk = f.read(end)
+                        view = memoryview(chunk)
+                        continue
+                    break
+                if crc32(view[offset + self.HEADER_SIZE:end]) != crc:
+                    logger.error('spool record crc mismatch in segment {}, dropped.'.format(seq))
+                    skipped += end - offset
+                else:
+                    # corrupt records in front of this one are released together with it.
+                    records.append(view[offset + self.HEADER_SIZE:end])
+                    self.__batch.append(end - offset + skipped)
+                    skipped = 0
+                offset = end
+            if skipped:
+                if records:
+                    self.__batch[-1] += skipped
+                else:
+                    self.__read_offset += skipped
+                    if self.__read_offset >= seg_size:
+                        self.__remove_oldest()
+                    self.__save_cursor()
+            return records
+
+    def commit(self, count=None):
+        """release the first `count` records (default all) returned by the last `read_batch`."""
+        with self.__lock:
+            if count is None:
+                count = len(self.__batch)
+            if count <= 0 or not self.__segments:
+                return
+            self.__read_offset += sum(self.__batch[:count])
+            self.__batch = []
+            if self.__read_offset >= self.__segments[0][1]:
+                self.__remove_oldest()
+            self.__save_cursor()
+
+    def clear(self):
+        with self.__lock:
+            while self.__segments:
+                self.__remove_oldest()
+            self.__save_cursor()
@@ -1,7 +1,9 @@
 import utime
 import usys
+import ustruct
 import _thread
 import osTimer
+from usr.utils import RingBuffer
 
 
 class Lock(object):
@@ -34,49 +36,65 @@ class Lock(object):
 
 
 class Waiter(object):
-    """WARNING: Waiter object can only be used once."""
+    """reusable binary semaphore a thread parks on while waiting for a `Condition`.
+
+    `release` (notify) and the timeout timer race for the one wakeup of a wait, whichever comes first wins and the
+    other becomes a no-op, so a waiter can go straight back to the pool after `acquire` returns. the timer is stopped
+    before that, and a callback of an earlier wait that still runs late is told apart by the deadline of the current
+    wait, it re-arms the timer for the remaining time instead of cutting the new wait short.
+    """
 
     def __init__(self):
-        self.__lock = Lock()
+        self.__lock = _thread.allocate_lock()
         self.__lock.acquire()
-        self.__gotit = True
-
-    @property
-    def unlock_timer(self):
-        timer = getattr(self, '__unlock_timer__', None)
-        if timer is None:
-            timer = osTimer()
-            setattr(self, '__unlock_timer__', timer)
-        return timer
-
-    def __auto_release(self, _):
-        if self.__release():
-            self.__gotit = False
-        else:
-            self.__gotit = True
+        self.__state = _thread.allocate_lock()
+        self.__armed = False
+        self.__signaled = False
+        self.__timer = None
+        self.__timer_armed = False
+        self.__deadline = 0
+
+    def __on_timeout(self, _):
+        with self.__state:
+            if not (self.__armed and self.__timer_armed):
+                return
+            remaining = utime.ticks_diff(self.__deadline, utime.ticks_ms())
+            if remaining > 0:
+                # stale callback of a previous wait, the current wait is not due yet.
+                self.__timer.stop()
+                self.__timer.start(remaining, 0, self.__on_timeout)
+                return
+            self.__armed = False
+            self.__lock.release()
 
     def acquire(self, timeout=-1):
-        """timeout <= 0 for blocking forever."""
-        if not self.__lock.locked():
-            raise RuntimeError('Waiter object can only be used once.')
-        self.__gotit = True
-        if timeout > 0:
-            self.unlock_timer.start(timeout * 1000, 0, self.__auto_release)
-        self.__lock.acquire()  # block here
-        if timeout > 0:
-            self.unlock_timer.stop()
-        self.__release()
-        return self.__gotit
-
-    def __release(self):
-        try:
-            self.__lock.release()
-        except RuntimeError:
-            return False
-        return True
+        """block until `release` or `timeout` seconds (fractions allowed, < 0 for forever), True if released."""
+        period = max(1, int(timeout * 1000)) if timeout >= 0 else 0
+        with self.__state:
+            self.__armed = True
+            self.__signaled = False
+            self.__timer_armed = timeout >= 0
+            self.__deadline = utime.ticks_add(utime.ticks_ms(), period)
+        if timeout >= 0:
+            if self.__timer is None:
+                self.__timer = osTimer()
+            self.__timer.start(period, 0, self.__on_timeout)
+        self.__lock.acquire()  # block here, relocked for the next wait once woken.
+        if timeout >= 0:
+            self.__timer.stop()
+        with self.__state:
+            self.__timer_armed = False
+            return self.__signaled
 
     def release(self):
-        return self.__release()
+        """wake the parked thread, False if it is not waiting (e.g. it already timed out)."""
+        with self.__state:
+            if not self.__armed:
+                return False
+            self.__armed = False
+            self.__signaled = True
+            self.__lock.release()
+            return True
 
 
 class Condition(object):
@@ -85,7 +103,8 @@ class Condition(object):
         if lock is None:
             lock = Lock()
         self.__lock = lock
-        self.__waiters = []
+        self.__waiters = []  # parked waiters, fifo
+        self.__pool = []  # idle waiters kept for reuse
         self.acquire = self.__lock.acquire
         self.release = self.__lock.release
 
@@ -99,33 +118,41 @@ class Condition(object):
         return self.__lock.locked() and self.__lock.owner == _thread.get_ident()
 
     def wait(self, timeout=None):
+        """wait for `notify`, `timeout` in seconds (fractions allowed). return False on timeout."""
         if not self.__is_owned():
             raise RuntimeError('cannot wait on un-acquired lock.')
-        waiter = Waiter()
+        if timeout is not None and timeout <= 0:
+            return False
+        waiter = self.__pool.pop() if self.__pool else Waiter()
         self.__waiters.append(waiter)
         self.release()
+        gotit = False
         try:
-            if timeout is None:
-                return waiter.acquire()
-            else:
-                return waiter.acquire(timeout)
+            gotit = waiter.acquire(-1 if timeout is None else timeout)
         finally:
             self.acquire()
-            self.__waiters.remove(waiter)
+            if not gotit and waiter in self.__waiters:
+                self.__waiters.remove(waiter)
+            self.__pool.append(waiter)
+        return gotit
 
     def wait_for(self, predicate, timeout=None):
-        endtime = None
-        remaining = timeout
+        """wait until `predicate()` is true or `timeout` seconds pass, return the last `predicate()` result.
+
+        the deadline is tracked in `utime.ticks_ms` (wraparound safe), so fractional timeouts keep ms resolution.
+        """
         result = predicate()
+        if timeout is None:
+            while not result:
+                self.wait()
+                result = predicate()
+            return result
+        deadline = utime.ticks_add(utime.ticks_ms(), int(timeout * 1000))
         while not result:
-            if remaining is not None:
-                if endtime is None:
-                    endtime = utime.time() + remaining
-                else:
-                    remaining = endtime - utime.time()
-                    if remaining <= 0.0:
-                        break
-            self.wait(remaining)
+            remaining = utime.ticks_diff(deadline, utime.ticks_ms())
+            if remaining <= 0:
+                break
+            self.wait(remaining / 1000)
             result = predicate()
         return result
 
@@ -134,14 +161,16 @@ class Condition(object):
             raise RuntimeError('cannot wait on un-acquired lock.')
         if n <= 0:
             raise ValueError('invalid param, n should be > 0.')
-        for waiter in self.__waiters[:n]:
-            waiter.release()
+        # released waiters leave the list, ones that already timed out do not count towards `n`.
+        while n > 0 and self.__waiters:
+            if self.__waiters.pop(0).release():
+                n -= 1
 
     def notify_all(self):
         if not self.__is_owned():
             raise RuntimeError('cannot wait on un-acquired lock.')
-        for waiter in self.__waiters:
-            waiter.release()
+        while self.__waiters:
+            self.__waiters.pop().release()
 
 
 class Event(object):
@@ -151,6 +180,7 @@ class Event(object):
         self.__cond = Condition()
 
     def wait(self, timeout=None):
+        """`timeout` in seconds, fractions give millisecond resolution."""
         with self.__cond:
             return self.__cond.wait_for(lambda: self.__flag, timeout=timeout)
 
@@ -177,46 +207,273 @@ class Queue(object):
         pass
 
     def __init__(self, max_size=100):
-        self.__deque = []
+        if max_size <= 0:
+            raise ValueError('max_size must be greater than 0.')
+        # preallocated slots used as a ring buffer, O(1) put/get.
+        self.__slots = [None] * max_size
         self.__max_size = max_size
+        self.__head = 0
+        self.__count = 0
+        self.__high_water = 0
         self.__lock = Lock()
         self.__not_empty = Condition(self.__lock)
         self.__not_full = Condition(self.__lock)
 
+    def __append(self, item):
+        self.__slots[(self.__head + self.__count) % self.__max_size] = item
+        self.__count += 1
+        if self.__count > self.__high_water:
+            self.__high_water = self.__count
+
+    def __popleft(self):
+        item = self.__slots[self.__head]
+        self.__slots[self.__head] = None  # drop reference for gc
+        self.__head = (self.__head + 1) % self.__max_size
+        self.__count -= 1
+        return item
+
     def put(self, item, block=True, timeout=None):
+        """`timeout` in seconds, fractions give millisecond resolution."""
         with self.__not_full:
             if not block:
-                if len(self.__deque) >= self.__max_size:
+                if self.__count >= self.__max_size:
                     raise self.Full
             elif timeout is not None and timeout <= 0:
                 raise ValueError("'timeout' must be a positive number.")
             else:
-                if not self.__not_full.wait_for(lambda: len(self.__deque) < self.__max_size, timeout=timeout):
+                if not self.__not_full.wait_for(lambda: self.__count < self.__max_size, timeout=timeout):
                     raise self.Full
-            self.__deque.append(item)
+            self.__append(item)
             self.__not_empty.notify()
 
+    def put_many(self, items, block=True, timeout=None):
+        """put items in order, return the number of items actually enqueued.
+
+        stop early (without raising `Full`) if no room is left and `block` is False or `timeout` expires.
+        """
+        if block and timeout is not None and timeout <= 0:
+            raise ValueError("'timeout' must be a positive number.")
+        total = 0
+        with self.__not_full:
+            for item in items:
+                if self.__count >= self.__max_size:
+                    if not block:
+                        break
+                    # let consumers drain what is already queued before waiting for room.
+                    self.__not_empty.notify(total or 1)
+                    if not self.__not_full.wait_for(lambda: self.__count < self.__max_size, timeout=timeout):
+                        break
+                self.__append(item)
+                total += 1
+            if total:
+                self.__not_empty.notify(total)
+        return total
+
     def get(self, block=True, timeout=None):
+        """`timeout` in seconds, fractions give millisecond resolution."""
         with self.__not_empty:
             if not block:
-                if len(self.__deque) == 0:
+                if self.__count == 0:
                     raise self.Empty
             elif timeout is not None and timeout <= 0:
                 raise ValueError("'timeout' must be a positive number.")
             else:
-                if not self.__not_empty.wait_for(lambda: len(self.__deque) != 0, timeout=timeout):
+                if not self.__not_empty.wait_for(lambda: self.__count != 0, timeout=timeout):
                     raise self.Empty
-            item = self.__deque.pop(0)
+            item = self.__popleft()
             self.__not_full.notify()
             return item
 
+    def get_many(self, max_items, block=True, timeout=None):
+        """get up to `max_items` items as a list, waiting (like `get`) only for the first one."""
+        if max_items <= 0:
+            raise ValueError("'max_items' must be greater than 0.")
+        with self.__not_empty:
+            if not block:
+                if self.__count == 0:
+                    raise self.Empty
+            elif timeout is not None and timeout <= 0:
+                raise ValueError("'timeout' must be a positive number.")
+            else:
+                if not self.__not_empty.wait_for(lambda: self.__count != 0, timeout=timeout):
+                    raise self.Empty
+            items = [self.__popleft() for _ in range(min(max_items, self.__count))]
+            self.__not_full.notify(len(items))
+            return items
+
     def size(self):
         with self.__lock:
-            return len(self.__deque)
+            return self.__count
+
+    qsize = size
+
+    @property
+    def max_size(self):
+        return self.__max_size
+
+    @property
+    def high_water_mark(self):
+        with self.__lock:
+            return self.__high_water
+
+    def reset_high_water_mark(self):
+        with self.__lock:
+            self.__high_water = self.__count
 
     def clear(self):
         with self.__lock:
-            self.__deque.clear()
+            for i in range(self.__max_size):
+                self.__slots[i] = None
+            self.__head = 0
+            self.__count = 0
+            self.__not_full.notify_all()
+
+
+class ByteQueue(object):
+    """bounded queue of byte records whose capacity is a byte budget rather than an item count.
+
+    records are copied into one preallocated ring buffer as
+    `<length:2><channel:1><origin:4><mark:4><stamp:4><payload>`, so neither `put` nor `get_into` allocate. `channel`
+    tags the producer when several share one queue, `origin` and `mark` are caller supplied ticks (e.g. for latency
+    tracing), `stamp` is the enqueue time in `utime.ticks_ms`. what happens when a record does not fit is decided by
+    `policy`:
+        block - wait for room (`Full` on timeout).
+        drop_oldest - discard queued records from the head until the new one fits.
+        drop_newest - discard the new record, `put` returns False.
+    """
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+    HEADER = '<HBIII'
+    HEADER_SIZE = ustruct.calcsize(HEADER)
+
+    class Full(Exception):
+        pass
+
+    class Empty(Exception):
+        pass
+
+    def __init__(self, capacity=8192, policy=BLOCK):
+        if policy not in self.POLICIES:
+            raise ValueError('overflow policy \"{}\" not supported, choose from {}.'.format(policy, self.POLICIES))
+        self.__ring = RingBuffer(capacity)
+        self.__policy = policy
+        self.__header = bytearray(self.HEADER_SIZE)
+        self.__count = 0
+        self.__high_water = 0
+        self.__dropped = 0
+        self.__dropped_bytes = 0
+        # header fields of the record returned by the last `get_into`, meant for the single consumer thread.
+        self.last_channel = 0
+        self.last_origin = 0
+        self.last_mark = 0
+        self.last_stamp = 0
+        self.__lock = Lock()
+        self.__not_empty = Condition(self.__lock)
+        self.__not_full = Condition(self.__lock)
+
+    @property
+    def policy(self):
+        return self.__policy
+
+    def __head_length(self):
+        return self.__ring.peek(0) | (self.__ring.peek(1) << 8)
+
+    def __drop_head(self):
+        length = self.__head_length()
+        self.__ring.consume(self.HEADER_SIZE + length)
+        self.__count -= 1
+        self.__dropped += 1
+        self.__dropped_bytes += length
+
+    def put(self, data, block=True, timeout=None, channel=0, origin=0, mark=0):
+        """enqueue a copy of `data`, return False if the record was dropped by the `drop_newest` policy."""
+        length = len(data)
+        need = self.HEADER_SIZE + length
+        if length > 0xFFFF or need > self.__ring.capacity:
+            raise ValueError('record of {} bytes exceeds queue capacity.'.format(length))
+        with self.__not_full:
+            if self.__ring.free() < need:
+                if self.__policy == self.DROP_OLDEST:
+                    while self.__ring.free() < need:
+                        self.__drop_head()
+                elif self.__policy == self.DROP_NEWEST or not block:
+                    self.__dropped += 1
+                    self.__dropped_bytes += length
+                    if self.__policy == self.DROP_NEWEST:
+                        return False
+                    raise self.Full
+                elif not self.__not_full.wait_for(lambda: self.__ring.free() >= need, timeout=timeout):
+                    raise self.Full
+            ustruct.pack_into(self.HEADER, self.__header, 0, length, channel, origin, mark, utime.ticks_ms())
+            self.__ring.write(self.__header)
+            self.__ring.write(data)
+            self.__count += 1
+            if len(self.__ring) > self.__high_water:
+                self.__high_water = len(self.__ring)
+            self.__not_empty.notify()
+            return True
+
+    def wait(self, timeout=None):
+        """block until a record is queued, False on timeout."""
+        with self.__not_empty:
+            return self.__not_empty.wait_for(lambda: self.__count != 0, timeout=timeout)
+
+    def get_into(self, buf, block=True, timeout=None):
+        """dequeue the oldest record into the writable buffer `buf`, return its length."""
+        with self.__not_empty:
+            if not block:
+                if self.__count == 0:
+                    raise self.Empty
+            elif not self.__not_empty.wait_for(lambda: self.__count != 0, timeout=timeout):
+                raise self.Empty
+            length = self.__head_length()
+            if length > len(buf):
+                raise ValueError('buffer too small for record of {} bytes.'.format(length))
+            self.__ring.readinto(self.__header)
+            (
+                _, self.last_channel, self.last_origin, self.last_mark, self.last_stamp
+            ) = ustruct.unpack_from(self.HEADER, self.__header)
+            self.__ring.readinto(memoryview(buf)[:length])
+            self.__count -= 1
+            self.__not_full.notify_all()
+            return length
+
+    def size(self):
+        """queued bytes, record headers included."""
+        with self.__lock:
+            return len(self.__ring)
+
+    def count(self):
+        with self.__lock:
+            return self.__count
+
+    def free(self):
+        """bytes left in the ring, a record needs `HEADER_SIZE` more than its payload."""
+        with self.__lock:
+            return self.__ring.free()
+
+    @property
+    def capacity(self):
+        return self.__ring.capacity
+
+    @property
+    def high_water_mark(self):
+        with self.__lock:
+            return self.__high_water
+
+    @property
+    def dropped(self):
+        """(records, bytes) discarded by the overflow policy."""
+        with self.__lock:
+            return self.__dropped, self.__dropped_bytes
+
+    def clear(self):
+        with self.__lock:
+            self.__ring.clear()
+            self.__count = 0
+            self.__not_full.notify_all()
 
 
 class _Result(object):
@@ -235,6 +492,7 @@ class _Result(object):
         self.__finished.set()
 
     def get(self, timeout=None):
+        """`timeout` in seconds, fractions give millisecond resolution."""
         if self.__finished.wait(timeout=timeout):
             if self.__exc:
                 raise self.__exc
@@ -304,43 +562,107 @@ class _WorkItem(object):
         except Exception as e:
             self.result.set(e, None)
         else:
-            self.result.set(rv, None)
-
-
-def _worker(work_queue):
-    while True:
-        try:
-            item = work_queue.get()
-            item.run()
-        except Exception as e:
-            usys.print_exception(e)
+            self.result.set(None, rv)
 
 
 class ThreadPoolExecutor(object):
 
-    def __init__(self, max_workers=4):
+    def __init__(self, max_workers=4, max_queue=100, name=None):
+        """name - when given, `queue_depth`/`active_workers`/`workers` are registered as `<name>.*` gauges."""
         if max_workers <= 0:
             raise ValueError('max_workers must be greater than 0.')
         self.__max_workers = max_workers
-        self.__work_queue = Queue()
-        self.__threads = set()
+        self.__work_queue = Queue(max_size=max_queue)
+        self.__threads = []  # [(thread, result of its run)]
+        self.__idle = 0  # waiting workers not yet claimed by a submitted item
+        self.__unclaimed = 0  # submitted items no waiting worker was claimed for
+        self.__active = 0
+        self.__shutdown = False
         self.__lock = Lock()
+        if name is not None:
+            from usr.metrics import Metrics  # usr.metrics imports this module
+            metrics = Metrics()
+            metrics.gauge('{}.queue_depth'.format(name), lambda: self.queue_depth)
+            metrics.gauge('{}.active_workers'.format(name), lambda: self.active_workers)
+            metrics.gauge('{}.workers'.format(name), lambda: self.workers)
+
+    @property
+    def queue_depth(self):
+        """work items submitted but not yet picked up by a worker."""
+        return self.__work_queue.size()
+
+    @property
+    def active_workers(self):
+        """workers currently running a work item."""
+        return self.__active
+
+    @property
+    def workers(self):
+        return len(self.__threads)
 
     def submit(self, fn, *args, **kwargs):
+        if self.__shutdown:
+            raise RuntimeError('cannot submit after shutdown.')
         item = _WorkItem(fn, args, kwargs)
         self.__work_queue.put(item)
         self.__adjust_thread_count()
         return item.result
 
+    def map(self, fn, *iterables, timeout=None, max_in_flight=None):
+        """yield `fn(*args)` for args zipped from `iterables` in order, with at most `max_in_flight` (default twice
+        `max_workers`) calls submitted ahead of the consumer. `timeout` applies to each result.
+        """
+        max_in_flight = max_in_flight or self.__max_workers * 2
+        pending = Queue(max_size=max_in_flight)
+        for args in zip(*iterables):
+            if pending.size() >= max_in_flight:
+                yield pending.get().get(timeout=timeout)
+            pending.put(self.submit(fn, *args))
+        while pending.size():
+            yield pending.get().get(timeout=timeout)
+
     def __adjust_thread_count(self):
         with self.__lock:
+            # claim a waiting worker for the new item, so back-to-back submits do not count the same one twice.
+            if self.__idle > 0:
+                self.__idle -= 1
+                return
+            self.__unclaimed += 1
             if len(self.__threads) < self.__max_workers:
-                t = Thread(target=_worker, args=(self.__work_queue,))
-                t.start()
-                self.__threads.add(t)
-
-    def shutdown(self):
+                t = Thread(target=self.__worker)
+                self.__threads.append((t, t.start()))
+
+    def __worker(self):
+        while True:
+            with self.__lock:
+                if self.__unclaimed > 0:
+                    self.__unclaimed -= 1
+                else:
+                    self.__idle += 1
+            item = self.__work_queue.get()
+            if item is None:
+                return
+            with self.__lock:
+                self.__active += 1
+            try:
+                item.run()
+            except Exception as e:
+                usys.print_exception(e)
+            finally:
+                with self.__lock:
+                    self.__active -= 1
+
+    def shutdown(self, wait=True):
+        """stop accepting work, let workers finish what is queued and exit. with `wait` block until they did."""
+        with self.__lock:
+            if self.__shutdown:
+                return
+            self.__shutdown = True
+            threads = list(self.__threads)
+        for _ in threads:
+            self.__work_queue.put(None)  # one exit sentinel per worker, queued behind the remaining work
+        if wait:
+            for _, result in threads:
+                result.get()
         with self.__lock:
-            for t in self.__threads:
-                t.stop()
-            self.__threads.clear()
+            self.__threads = []
@@ -0,0 +1,49 @@
+import utime
+from usr.metrics import Metrics
+from usr.logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class Tracer(object):
+    """aggregate per-message hop latencies into histograms.
+
+    a message is traced by `record(t0, t1, ..., tn)`, the `utime.ticks_ms` stamps taken at every hop. hop i lasts
+    t(i+1) - t(i) and is named `stages[i]`, the sum goes to the `total` histogram. with `sample_every` N > 0 the full
+    breakdown of 1-in-N messages is also logged at INFO, the tracing logger is then set to INFO so the samples show
+    up under the default WARN level too.
+    """
+
+    def __init__(self, name, stages, sample_every=0):
+        self.name = name
+        self.stages = tuple(stages)
+        metrics = Metrics()
+        self.__histograms = [metrics.histogram('{}.{}_ms'.format(name, stage)) for stage in self.stages]
+        self.__total = metrics.histogram('{}.total_ms'.format(name))
+        self.__sample_every = sample_every
+        self.__seen = 0
+        if sample_every > 0:
+            logger.setLevel('INFO')
+
+    def record(self, *stamps):
+        if len(stamps) != len(self.stages) + 1:
+            raise ValueError('{} expects {} stamps.'.format(self.name, len(self.stages) + 1))
+        for i in range(len(self.stages)):
+            self.__histograms[i].observe(utime.ticks_diff(stamps[i + 1], stamps[i]))
+        total = utime.ticks_diff(stamps[-1], stamps[0])
+        self.__total.observe(total)
+        self.__seen += 1
+        if self.__sample_every > 0 and self.__seen % self.__sample_every == 0:
+            logger.infof('%s trace: %s, total %d ms', self.name, ', '.join([
+                '{} {} ms'.format(self.stages[i], utime.ticks_diff(stamps[i + 1], stamps[i]))
+                for i in range(len(self.stages))
+            ]), total)
+
+    def summary(self):
+        """{stage: {'count', 'avg', 'max', 'p50', 'p95', 'p99'}} including `total`."""
+        rv = {}
+        for i in range(len(self.stages)):
+            rv[self.stages[i]] = self.__histograms[i].summary()
+        rv['total'] = self.__total.summary()
+        return rv
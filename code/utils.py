@@ -1,3 +1,4 @@
+import ubinascii
 
 
 class Singleton(object):
@@ -12,3 +13,147 @@ class Singleton(object):
 
     def __repr__(self):
         return repr(self.cls)
+
+
+_crc32_table = None
+
+
+def _crc32(data, crc=0):
+    global _crc32_table
+    if _crc32_table is None:
+        _crc32_table = []
+        for i in range(256):
+            c = i
+            for _ in range(8):
+                c = (c >> 1) ^ 0xEDB88320 if c & 1 else c >> 1
+            _crc32_table.append(c)
+    crc ^= 0xFFFFFFFF
+    for b in data:
+        crc = _crc32_table[(crc ^ b) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+# use the firmware implementation when the port provides it.
+crc32 = getattr(ubinascii, 'crc32', _crc32)
+
+
+class RingBuffer(object):
+    """fixed-capacity byte ring buffer backed by one preallocated bytearray.
+
+    data is exposed as memoryview slices (`read_view`/`write_view`), so producers and consumers can work on it
+    without allocating new bytes objects.
+    """
+
+    def __init__(self, capacity):
+        if capacity <= 0:
+            raise ValueError('capacity must be greater than 0.')
+        self.__buf = bytearray(capacity)
+        self.__view = memoryview(self.__buf)
+        self.__capacity = capacity
+        self.__head = 0
+        self.__size = 0
+
+    def __len__(self):
+        return self.__size
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    def free(self):
+        return self.__capacity - self.__size
+
+    def clear(self):
+        self.__head = 0
+        self.__size = 0
+
+    def write_view(self):
+        """contiguous writable region at the tail, fill it then call `commit`."""
+        if self.__size == self.__capacity:
+            return self.__view[0:0]
+        tail = (self.__head + self.__size) % self.__capacity
+        if tail >= self.__head:
+            return self.__view[tail:self.__capacity]
+        return self.__view[tail:self.__head]
+
+    def commit(self, n):
+        if n < 0 or n > self.free():
+            raise ValueError('commit size out of range.')
+        self.__size += n
+
+    def write(self, data):
+        """copy as much of `data` as fits, return the number of bytes written."""
+        total = 0
+        length = len(data)
+        while total < length:
+            view = self.write_view()
+            n = min(len(view), length - total)
+            if n == 0:
+                break
+            view[:n] = data[total:total + n]
+            self.commit(n)
+            total += n
+        return total
+
+    def read_view(self, n=-1):
+        """contiguous readable region at the head (at most `n` bytes), release it with `consume`."""
+        end = min(self.__head + self.__size, self.__capacity)
+        if 0 <= n < end - self.__head:
+            end = self.__head + n
+        return self.__view[self.__head:end]
+
+    def consume(self, n):
+        if n < 0 or n > self.__size:
+            raise ValueError('consume size out of range.')
+        self.__size -= n
+        if self.__size == 0:
+            self.__head = 0
+        else:
+            self.__head = (self.__head + n) % self.__capacity
+
+    def readinto(self, buf):
+        """copy up to len(buf) bytes into `buf` and consume them, return the number of bytes copied."""
+        total = 0
+        length = len(buf)
+        while total < length and self.__size:
+            view = self.read_view(length - total)
+            n = len(view)
+            buf[total:total + n] = view
+            self.consume(n)
+            total += n
+        return total
+
+    def find(self, sub, start=0):
+        """index of bytes `sub` in the buffered data at or after `start`, -1 if not found.
+
+        the buffered data is at most two contiguous segments, each is searched with `bytes.find`, a match straddling
+        the end of the buffer is looked for in the join of both segments' edges.
+        """
+        length = len(sub)
+        if length == 0:
+            return start if start <= self.__size else -1
+        end = self.__head + self.__size
+        first = min(end, self.__capacity) - self.__head  # bytes in the segment at the head
+        if start < first:
+            index = bytes(self.__view[self.__head + start:self.__head + first]).find(sub)
+            if index >= 0:
+                return start + index
+        if end <= self.__capacity:
+            return -1
+        second = end - self.__capacity  # bytes wrapped around to the start of the buffer
+        if start < first and length > 1:
+            low = max(start, first - length + 1)
+            join = bytes(self.__view[self.__head + low:self.__capacity]) + bytes(self.__view[:min(second, length - 1)])
+            index = join.find(sub)
+            if index >= 0:
+                return low + index
+        offset = max(0, start - first)
+        index = bytes(self.__view[offset:second]).find(sub)
+        if index >= 0:
+            return first + offset + index
+        return -1
+
+    def peek(self, index):
+        if index < 0 or index >= self.__size:
+            raise IndexError('ring buffer index out of range.')
+        return self.__buf[(self.__head + index) % self.__capacity]